@@ -1,5 +1,13 @@
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import json
+import os
+import os.path
+from functools import cache
 from config import config
+from util import file_hash
+from cached_csv_from_xls import cached_data_dir
 
 
 def try_unicode(str):
@@ -12,28 +20,90 @@ def try_unicode(str):
 originals_folder = config['General']['originals_folder']
 airports_ext = config['General']['airports_extended']
 
-# openflights database
-# airport_database = pd.read_csv("assets/airports.csv")
-
 # datahub.io
-airport_database_orig = pd.read_csv('assets/airport-codes_csv.csv')
+airport_codes_path = 'assets/airport-codes_csv.csv'
+airport_sources = [airport_codes_path, f'{originals_folder}/{airports_ext}']
+
+####
+# The datahub database has ~60k airports, but we only look up a few hundred iata codes.
+# So we keep a compact artifact of the airports with an iata code, which is rebuilt only when one of
+# the airport_sources changes (their content hashes are stored with the artifact).
+####
+airport_index_path = f'{cached_data_dir}/airports-iata.parquet'
+# Bump this whenever the content or layout of the artifact changes.
+airport_index_version = 2
+airport_index_columns = ['iata', 'city', 'country', 'lon', 'lat']
+
+
+def _source_hashes():
+    return {'version': airport_index_version,
+            'sources': {path: file_hash(path) for path in airport_sources}}
+
+
+def _build_airport_index():
+    source_columns = ['type', 'iata_code', 'iso_country', 'municipality', 'coordinates']
+    airport_database = pd.concat([
+        pd.read_csv(path, usecols=lambda col: col in source_columns) for path in airport_sources])
+
+    # datahub-specific: need to remove "closed" records as otherwise we get duplicate
+    # iata codes (e.g. HKG, MUC)
+    airport_database = airport_database[(airport_database['type'] != 'closed')
+                                        & airport_database['iata_code'].notna()]
+    # harmonize this with current code for now
+    airport_database = airport_database.rename(
+        columns={'iso_country': 'country', 'municipality': 'city', 'iata_code': 'iata'})
+    # Convert Ã¼ to ü etc.
+    # TODO: Find a better source or improve how we get the datahub data.
+    airport_database['country'] = airport_database['country'].map(try_unicode)
+    airport_database['city'] = airport_database['city'].map(try_unicode)
+
+    coordinates = airport_database['coordinates'].str.split(', ', n=1, expand=True)
+    # float32 is precise to a few meters, plenty for airports.
+    airport_database['lon'] = coordinates[0].astype('float32')
+    airport_database['lat'] = coordinates[1].astype('float32')
+
+    return airport_database[airport_index_columns].sort_values('iata').reset_index(drop=True)
+
+
+def _read_airport_index(hashes):
+    if not os.path.isfile(airport_index_path):
+        return None
+
+    table = pq.read_table(airport_index_path)
+    stored = (table.schema.metadata or {}).get(b'airport_sources')
+    if stored is None or json.loads(stored) != hashes:
+        return None
+
+    return table.to_pandas()
+
+
+####
+# Load the airports with iata code (from the artifact, or from the sources if they changed), indexed by iata.
+# This is only done on first use, and then memoized. Call invalidate_airport_database after changing the
+# extension file.
+####
+@cache
+def get_airport_database():
+    hashes = _source_hashes()
+    airport_index = _read_airport_index(hashes)
+
+    if airport_index is None:
+        print('Info: Building the airport index from the airport database and extension file.')
+        airport_index = _build_airport_index()
+
+        table = pa.Table.from_pandas(airport_index, preserve_index=False)
+        table = table.replace_schema_metadata({
+            **(table.schema.metadata or {}), b'airport_sources': json.dumps(hashes)})
+        os.makedirs(cached_data_dir, exist_ok=True)
+        # Write to a temp file first, so an interrupted run can't leave a corrupt artifact behind.
+        pq.write_table(table, f'{airport_index_path}.tmp')
+        os.replace(f'{airport_index_path}.tmp', airport_index_path)
 
-airport_extension = pd.read_csv(f'{originals_folder}/{airports_ext}')
+    return airport_index.set_index('iata')
 
-airport_database = pd.concat([airport_database_orig, airport_extension])
 
-# datahub-specific: need to remove "closed" records as otherwise we get duplicate
-# iata codes (e.g. HKG, MUC)
-airport_database = airport_database[airport_database['type'] != 'closed']
-# harmonize this with current code for now
-airport_database = airport_database.rename(
-    columns={'iso_country': 'country', 'municipality': 'city', 'iata_code': 'iata'})
-# Convert Ã¼ to ü etc.
-# TODO: Find a better source or improve how we get the datahub data.
-airport_database['country'] = airport_database.apply(
-    lambda row: try_unicode(row['country']), axis=1)
-airport_database['city'] = airport_database.apply(
-    lambda row: try_unicode(row['city']), axis=1)
+def invalidate_airport_database():
+    get_airport_database.cache_clear()
 
 
 # Get a frame of unique iata entries used in iata_series_list, together with
@@ -41,22 +111,18 @@ airport_database['city'] = airport_database.apply(
 # This is later stored in cockpit.
 def _legs_airport_info(*iata_series_list):
     iata_series = pd.concat(iata_series_list, axis=0)
-    iata = pd.DataFrame(
-        {'iata': iata_series.str.upper().sort_values().unique()})
+    iata = pd.Index(iata_series.dropna().str.upper().unique()).sort_values()
 
-    airport_info = pd.merge(iata, airport_database, how='left', on='iata')
-    airport_info[['lon', 'lat']] = airport_info['coordinates'].str.split(
-        ', ', 1, expand=True)
-    airport_info.lon = airport_info.lon.astype('float')
-    airport_info.lat = airport_info.lat.astype('float')
-    airport_info = airport_info[['city', 'country', 'iata', 'lon', 'lat']]
+    airport_database = get_airport_database()
+    found = airport_database[airport_database.index.isin(iata)]
 
-    iata_dupes = list(airport_info[airport_info['iata'].duplicated()]['iata'])
+    iata_dupes = list(found.index[found.index.duplicated()].unique())
     if len(iata_dupes):
         raise Exception(
             f"Unexpected error: airport_info has duplicate iata codes {', '.join(iata_dupes)}")
 
-    airport_info = airport_info.set_index('iata')
+    airport_info = found.reindex(iata)
+    airport_info.index.name = 'iata'
 
     return airport_info
 
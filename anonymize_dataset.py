@@ -1,7 +1,15 @@
 import pandas as pd
-from random import randrange
-from datetime import timedelta
-from functools import cache
+import numpy as np
+import hashlib
+import hmac
+import os.path
+import secrets
+from config import config
+
+date_shift_key_path = f"{config['General']['originals_folder']}/{config['anonymization']['date_shift_key']}"
+
+# Dates are moved by 1 to max_date_shift days.
+max_date_shift = 14
 
 # This is a placeholder function for now.
 # Later, it'll have to work on the complete dataset including GHG and HR data.
@@ -27,34 +35,41 @@ def anonymize_dataset(orig_df):
     return df
 
 
-# Generate arbitrary day offset per trip but same for all legs of a trip.
-@cache
-def _get_offset(trip_id):
-    while True:
-        # We're moving into future only to avoid
-        # 2016 records which would look strange.
-        rnd = randrange(0, 15)
-        if rnd != 0:
-            break
-    return rnd
-
+####
+# Move all legs of a trip by the same arbitrary number of days (1 to 14).
+#
+# The offset of a trip is derived from its trip id with a keyed hash (HMAC), so reruns on the same
+# data move dates the same way. Without the key, the offsets can't be recomputed. The key is created on
+# first use and kept with the originals (see date_shift_key in config.yml), never in the outputs.
+####
+def _date_shift_key():
+    if not os.path.isfile(date_shift_key_path):
+        with open(date_shift_key_path, 'w') as f:
+            f.write(secrets.token_hex(32))
+        print(f'Info: created a new date shift key in {date_shift_key_path}.')
 
-def _date_offset(row):
-    offset = _get_offset(row['trip_id'])
+    with open(date_shift_key_path, 'r') as f:
+        return f.read().strip().encode('utf-8')
 
-    # datetime representation
-    leg_date = pd.to_datetime(row['leg_date'])
-    # add offset
-    # leg_date += timedelta(days=_date_offset_lookup[key])
-    leg_date += timedelta(days=offset)
-
-    # back to string
-    str_date = leg_date.strftime('%Y-%m-%d')
 
-    return str_date
+def _trip_offsets(trip_ids, key):
+    digests = [hmac.new(key, str(trip_id).encode('utf-8'), hashlib.sha256).digest()
+               for trip_id in trip_ids]
+    # We're moving into future only to avoid
+    # 2016 records which would look strange.
+    return 1 + np.frombuffer(b''.join(d[:8] for d in digests), dtype='>u8') % max_date_shift
 
 
 def move_dates(orig_df):
     df = pd.DataFrame.copy(orig_df)
-    df['leg_date'] = df.apply(lambda row: _date_offset(row), axis=1)
+
+    trip_ids = df['trip_id'].unique()
+    offsets = pd.Series(_trip_offsets(
+        trip_ids, _date_shift_key()), index=trip_ids)
+
+    leg_dates = pd.to_datetime(df['leg_date'])
+    moved = leg_dates + pd.to_timedelta(df['trip_id'].map(offsets), unit='D')
+
+    # back to string
+    df['leg_date'] = moved.dt.strftime('%Y-%m-%d')
     return df
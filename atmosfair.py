@@ -1,6 +1,6 @@
 ####
 # upfront:
-# 1. read cache.
+# 1. bring the cache (atmosfair_store.py) up to date with new responses.
 #
 # Runtime:
 # 1. For every leg, try to associate cached atmosfair data
@@ -9,26 +9,30 @@
 ####
 from config import config
 import pandas as pd
+import numpy as np
 from excel_writer_formatted import to_excel
 import re
 import os.path
 import glob
-from datetime import datetime
-from util import file_timestamp
+from datetime import datetime, timedelta
+from functools import cache
+from util import file_hash
+from atmosfair_store import open_store, ingested_hashes, ingest, lookup, store_path, \
+    open_ledger, record_requests, open_requests, close_requests
 
 # Build the cache from the atmosfair xls responses or csv responses.
 # We started out by using xls and then moved to csv.
 file_origin = 'csv'
 
-print('TODO: Warn on atmosfair response "INT-INT" and handle Aircraft = "Train"')
-
 originals_path = config['General']['originals_folder']
 output_folder = config['General']['output_folder']
 atmosfair_responses_folder = config['atmosfair']['responses_folder']
 
 atmos_responses_path = f"{originals_path}/{atmosfair_responses_folder}"
-all_atmos_response_files = glob.glob(
-    os.path.join(atmos_responses_path, "*.csv"))
+# Open requests older than this are assumed lost, and their flights are requested again.
+request_timeout_days = config['atmosfair']['request_timeout_days']
+# Maximum number of flights per request file, 0 for no limit.
+max_request_size = config['atmosfair']['max_request_size']
 
 
 atmos_date_col = {'xls': 'Flight date', 'csv': 'flightDate'}
@@ -156,15 +160,14 @@ q_keys = ['from', 'to', 'class', 'leg_date', 'flight_number']
 
 drop_keys = {'xls': ['Activity', 'charter', 'UniqueID atmosfair', 'pax_count'],
              'csv': ['charter', 'UniqueID atmosfair', 'pax_count']}
-# Everything we do not remove.
-keep_keys = list(set(list(atmos_inv_mapping)) - set(drop_keys[file_origin]))
+# Everything we do not remove, in a stable order for the store. Keys first.
+store_columns = q_keys + [v for v in atmos_inv_mapping
+                          if v not in q_keys and v not in drop_keys[file_origin]]
 
 # We assume we're missing results if this col is not defined.
 # We'd normally use the plain `CO2` but that one has mis-formatted column header in atmosfair shipment 1.
 result_sample_key = atmos_def['co2rfi2']
 
-atmosfair_cache = None
-
 # We have 2 columns identically named 'aircraft' and atmosfair ensures us that the second one is populated
 # by them. The first one apparently is the one sent by us to them per their data specs, which is empty though.
 # This function naming the one by atmosfair 'aircraft'. It also handles the possibility that we only get their aircraft column,
@@ -187,39 +190,94 @@ def fix_duplicate_aircraft_col(df):
     return df
 
 
-# Build atmosfair_cache from csv files at startup.
-if len(all_atmos_response_files):
-    atmosfair_cache = pd.concat(fix_duplicate_aircraft_col(
-        pd.read_csv(f, dtype=str)) for f in all_atmos_response_files)
+# Normalize a single atmosfair response file to our column names.
+def _read_response(path):
+    response = fix_duplicate_aircraft_col(pd.read_csv(path, dtype=str))
 
     # Fix that Unnamed: 11 column which sometimes occurs in atmosfair shipments and doesn't mean anything.
     # (Minor. Reason: they say we shipped it - could check if our shipments to them end the line with a comma)
-    if 'Unnamed: 11' in atmosfair_cache.columns:
-        atmosfair_cache.drop(columns='Unnamed: 11', inplace=True)
+    if 'Unnamed: 11' in response.columns:
+        response.drop(columns='Unnamed: 11', inplace=True)
 
-    atmosfair_cache = atmosfair_cache.astype(
-        {v: float for v in raw_floats[file_origin]})
+    response = response.astype({v: float for v in raw_floats[file_origin]})
     # Be extra careful about day order of dates for parsing, since that has changed back and forth during the project.
     # Standardize the internal represenation of dates as iso.
-    sample_date = atmosfair_cache.iloc[0][atmos_date_col[file_origin]]
+    sample_date = response.iloc[0][atmos_date_col[file_origin]] if len(
+        response) else ''
     if re.match(r'^[0-9]{2}\.[0-9]{2}\.20[0-9]{2}', sample_date):
-        atmosfair_cache[atmos_date_col[file_origin]] = pd.to_datetime(
-            atmosfair_cache[atmos_date_col[file_origin]], dayfirst=True).dt.strftime('%Y-%m-%d')
+        response[atmos_date_col[file_origin]] = pd.to_datetime(
+            response[atmos_date_col[file_origin]], dayfirst=True).dt.strftime('%Y-%m-%d')
     else:
-        raise Exception('Double-check date format of atmosfair cache!')
+        raise Exception(f'Double-check date format of atmosfair response {path}!')
 
-    atmosfair_cache.rename(columns=atmos_mapping[file_origin], inplace=True)
+    response.rename(columns=atmos_mapping[file_origin], inplace=True)
 
     # Importantly, drop pax_count which we expect to always be ==1. Otherwise, this could get confused when merging cache with real legs.
     for drop_key in drop_keys[file_origin]:
-        if drop_key in atmosfair_cache.columns:
-            atmosfair_cache.drop(columns=[drop_key], inplace=True)
+        if drop_key in response.columns:
+            response.drop(columns=[drop_key], inplace=True)
+
+    # Keys are filled with '' to ensure correct merging, see merge_emissions.
+    # Results stay nan, so missing results remain recognizable in the store.
+    text_cols = [c for c in response.columns if c not in
+                 [atmos_mapping[file_origin][f] for f in raw_floats[file_origin]]]
+    response[text_cols] = response[text_cols].fillna('')
+
+    return response
+
+
+####
+# Bring the atmosfair store up to date with the csv responses. Only files not ingested before are read.
+# This is done on first use, and then memoized.
+# Call invalidate_atmosfair_cache after new responses arrived to pick them up.
+####
+@cache
+def sync_atmosfair_store():
+    print('TODO: Warn on atmosfair response "INT-INT" and handle Aircraft = "Train"')
+
+    # Responses are timestamped, so in name order later responses replace earlier ones.
+    all_atmos_response_files = sorted(glob.glob(
+        os.path.join(atmos_responses_path, "*.csv")))
+
+    con = open_store(store_columns, q_keys)
+    ledger = open_ledger(q_keys)
+    try:
+        ingested = ingested_hashes(con)
+        new_count = 0
+        for f in all_atmos_response_files:
+            content_hash = file_hash(f)
+            if content_hash in ingested:
+                continue
+
+            response = _read_response(f)
+            ingest(con, response, content_hash, f)
+            close_requests(ledger, response[q_keys], f)
+            ingested.add(content_hash)
+            new_count += 1
+    finally:
+        con.close()
+        ledger.close()
+
+    print(
+        f"Info: atmosfair store: ingested {new_count} new of {len(all_atmos_response_files)} response files.")
+
+    return store_path
 
-    # fillna('') is to ensure correct merging, see below
-    atmosfair_cache.fillna('', inplace=True)
-    # Finally, create correct format.
-else:
-    atmosfair_cache = pd.DataFrame(columns=keep_keys)
+
+def invalidate_atmosfair_cache():
+    sync_atmosfair_store.cache_clear()
+
+
+# Look up the cached emissions for the given legs keys (see q_keys). Returns one row per known flight.
+def lookup_emissions(keys_df):
+    con = open_store(store_columns, q_keys, sync_atmosfair_store())
+    try:
+        found = lookup(con, keys_df[q_keys])
+    finally:
+        con.close()
+
+    # Undefined emission values are '', only flights which are not cached at all have NaN.
+    return found.fillna('')
 
 
 def _to_atmosfair_format(df):
@@ -236,42 +294,117 @@ def _to_atmosfair_format(df):
     return atmos
 
 
-# NOTE: This merges atmosfair GHG data but does not consider pax_count > 1.
-# The latter has to be adjusted in a separate step.
-def merge_emissions(raw_legs_df):
-    legs = pd.DataFrame.copy(raw_legs_df)
+####
+# Integer flight keys: every distinct combination of q_keys gets one int64 code, in order of first appearance.
+# Each key column is factorized into its own dictionary (leg dates by day), and undefined values (NaN/NaT
+# or '') explicitly share one code. Column codes are combined one column at a time and compressed again
+# after each step, so the combined code can't overflow however many distinct values there are.
+####
+def _flight_codes(legs):
+    codes = np.zeros(legs.shape[0], dtype='int64')
+    for key in q_keys:
+        values = legs[key]
+        if key == 'leg_date':
+            values = values.dt.floor('D')
+        else:
+            values = values.mask(values == '')
+        key_codes, uniques = pd.factorize(values)
+        # Undefined values are -1, so shift everything by one.
+        codes, _ = pd.factorize(codes * (len(uniques) + 1) + key_codes + 1)
 
-    # The merge is not predictable on nan keys:
-    # https://stackoverflow.com/questions/53688988/why-does-pandas-merge-on-nan
-    # Therefore, create predictable keys.
-    # This will convert nat to nan
-    legs['leg_date'] = legs['leg_date'].dt.strftime('%Y-%m-%d')
-    # And now that everything undefined is nan, we can fill
-    legs.fillna('', inplace=True)
+    return codes
 
-    with_cache = pd.merge(legs, atmosfair_cache, how='left', on=q_keys)
 
-    missing = with_cache[with_cache[result_sample_key].isna()
-                         ][q_keys]
+####
+# Create a new request file, opened for writing. Returns [path, file].
+# Never overwrites an earlier request (e.g. of a run in the same second): its flights are in the ledger already.
+####
+def _new_request_file(name):
+    counter = 0
+    while True:
+        path = f"{output_folder}/to_atmosfair_{name}{f'_{counter}' if counter else ''}.csv"
+        try:
+            return [path, open(path, 'x', newline='')]
+        except FileExistsError:
+            counter += 1
+
+
+####
+# Write request files for the missing flights (distinct keys) which were not requested before.
+# Flights of open requests (see the ledger in atmosfair_store.py) are skipped, unless the request is older
+# than request_timeout_days. New requests are split into files of at most max_request_size flights.
+# Returns the new request files, and the earlier request files we are still waiting for.
+####
+def _request_missing(missing):
+    now = datetime.now()
+    since = (now - timedelta(days=request_timeout_days)).isoformat(timespec='seconds')
+
+    ledger = open_ledger(q_keys)
+    try:
+        awaited = open_requests(ledger, missing, since)
+        awaited_flights = pd.MultiIndex.from_frame(awaited[q_keys])
+        new_missing = missing[~pd.MultiIndex.from_frame(missing).isin(awaited_flights)]
+
+        if len(awaited):
+            print(f"Info: {awaited[q_keys].drop_duplicates().shape[0]} missing flights were requested "
+                  "before and are awaiting an atmosfair response.")
+
+        batch_size = max_request_size if max_request_size > 0 else max(len(new_missing), 1)
+        batches = [new_missing[start:start + batch_size]
+                   for start in range(0, len(new_missing), batch_size)]
+
+        ghg_request_files = []
+        for i, batch in enumerate(batches):
+            suffix = f"-{i + 1}" if len(batches) > 1 else ''
+            [ghg_request_filepath, request_file] = _new_request_file(
+                now.strftime('%Y%m%d%H%M%S') + suffix)
+
+            atmos_transfer = _to_atmosfair_format(batch)
 
-    miss_count = missing.shape[0]
+            with request_file:
+                atmos_transfer.to_csv(request_file, index=False)
+            # If we wanted an excel for users.
+            # to_excel(atmos_transfer, f"{output_folder}/{filename}", index=False)
+
+            record_requests(ledger, batch, ghg_request_filepath,
+                            now.isoformat(timespec='seconds'))
+            ghg_request_files.append(ghg_request_filepath)
+    finally:
+        ledger.close()
+
+    return [ghg_request_files, sorted(awaited['request'].unique())]
+
+
+# NOTE: This merges atmosfair GHG data but does not consider pax_count > 1.
+# The latter has to be adjusted in a separate step.
+def merge_emissions(raw_legs_df):
+    # Callers rely on undefined values being '' (leg dates stay datetime).
+    legs = raw_legs_df.fillna(
+        {col: '' for col in raw_legs_df.columns if col != 'leg_date'}).reset_index(drop=True)
+
+    # Legs are joined to their flight by integer code. Only the distinct flights need the string keys
+    # of the store.
+    flight_codes = _flight_codes(raw_legs_df)
+    _, first_legs = np.unique(flight_codes, return_index=True)
+    flights = legs.loc[first_legs, q_keys].reset_index(drop=True)
+    flights['leg_date'] = flights['leg_date'].dt.strftime('%Y-%m-%d').fillna('')
+
+    # The store holds each flight once, so flights keeps one row per flight code, in code order.
+    flights = pd.merge(flights, lookup_emissions(flights), how='left', on=q_keys)
+    emissions = flights.drop(columns=q_keys)
+    with_cache = pd.concat(
+        [legs, emissions.take(flight_codes).reset_index(drop=True)], axis=1)
+
+    # One record per unique flight, to add to the cache
+    missing = flights[flights[result_sample_key].isna()][q_keys]
+
+    miss_count = with_cache[result_sample_key].isna().sum()
     catch_hits = with_cache.shape[0] - miss_count
 
     print(f"Info: atmosfair cache hits: {catch_hits} of {legs.shape[0]}.", end=" ")
     print(
         f"Total legs including \"pax count > 1\" entries: {with_cache['pax_count'].astype('int').sum()}")
-    ghg_request_filepath = None
-
-    if miss_count > 0:
-        # We only need/want one record per unique flight, to add to the cache
-        missing = missing[missing.duplicated(q_keys) == False]
-
-        ghg_request_filepath = f"{output_folder}/to_atmosfair_{file_timestamp()}.csv"
-
-        atmos_transfer = _to_atmosfair_format(missing)
 
-        atmos_transfer.to_csv(ghg_request_filepath, index=False)
-        # If we wanted an excel for users.
-        # to_excel(atmos_transfer, f"{output_folder}/{filename}", index=False)
+    [ghg_request_files, awaited_requests] = _request_missing(missing)
 
-    return [with_cache, ghg_request_filepath]
+    return [with_cache, ghg_request_files, awaited_requests]
@@ -0,0 +1,99 @@
+####
+# Local stand-in for the atmosfair service, to test and benchmark the request -> response -> store loop
+# without the email exchange.
+#
+# Reads request files written by merge_emissions (to_atmosfair_*.csv in the output folder) and writes a
+# response for each into the responses folder, in the csv layout of real atmosfair responses (including the
+# two `aircraft` columns). Emissions are made up, but deterministic: great-circle distance between the
+# airports times a factor per travel class. Flights with unknown airports get no emission values.
+#
+# NEVER put stand-in responses into the responses folder of production data: they would end up in the store.
+#
+# Usage: python atmosfair_standin.py [request files]
+# Without arguments, answers all request files in the output folder which have no stand-in response yet.
+####
+import sys
+import glob
+import os.path
+import numpy as np
+import pandas as pd
+from atmosfair import atmos_responses_path, output_folder
+from emission_estimate import great_circle_km, airport_coordinates, class_factors
+
+# Response columns, in the order atmosfair sends them. The first `aircraft` is the (empty) one we sent.
+response_columns = ['departure', 'arrival', 'pax', 'travelClass', 'flightNumber', 'flightDate', 'aircraft',
+                    'charter', 'UniqueID atmosfair', 'flight', 'specific fuel consumption',
+                    'share of fuel use in cruise', 'fuel use', 'fuel use in critical altitudes', 'CO2', 'CO2RFI2',
+                    'CO2RFI2.7', 'CO2RFI4', 'CO2DEFRA', 'CO2GHGGRI', 'CO2ICAO', 'CO2VFU', 'aircraft', 'distance',
+                    'cruise altitude', 'method']
+
+# t CO2 per passenger km in economy.
+co2_per_km = 0.00009
+# t CO2 per t kerosene.
+co2_per_fuel = 3.15
+# Share of fuel burnt in critical altitudes, where the radiative forcing index (RFI) applies.
+critical_share = 0.85
+
+
+# The response for one request (as written by _to_atmosfair_format).
+def synthesize_response(request):
+    [from_lon, from_lat] = airport_coordinates(request['departure'])
+    [to_lon, to_lat] = airport_coordinates(request['arrival'])
+    distance = great_circle_km(from_lon, from_lat, to_lon, to_lat).round()
+
+    factor = request['travelClass'].str.upper().map(class_factors).fillna(1.0).to_numpy()
+    co2 = distance * co2_per_km * factor
+    fuel = co2 / co2_per_fuel
+    long_haul = distance > 3000
+
+    values = [
+        request['departure'], request['arrival'], request['pax'], request['travelClass'],
+        request['flightNumber'], request['flightDate'], '', '', '',
+        np.where(np.isnan(distance), 'unknown airport', 'ok'),
+        # liters per 100 passenger km
+        fuel * 1250 / np.where(distance > 0, distance, np.nan) * 100,
+        [f'{share:.2f}%' for share in np.where(long_haul, 92.0, 85.0)],
+        fuel, fuel * critical_share, co2,
+        co2 * (1 + critical_share * (2 - 1)),
+        co2 * (1 + critical_share * (2.7 - 1)),
+        co2 * (1 + critical_share * (4 - 1)),
+        co2 * 1.9, co2, co2 * 0.8, co2 * 1.1,
+        np.where(long_haul, 'Airbus A330-300', 'Airbus A320'),
+        distance, np.where(long_haul, 11000, 9000), 'standin'
+    ]
+
+    # Columns by position, as `aircraft` is there twice.
+    response = pd.DataFrame({i: value for i, value in enumerate(values)},
+                            index=request.index)
+    response.columns = response_columns
+
+    return response
+
+
+def response_path(request_path):
+    return f"{atmos_responses_path}/standin-{os.path.basename(request_path)}"
+
+
+# Answer one request file. Returns the path of the response.
+def answer_request(request_path):
+    request = pd.read_csv(request_path, dtype=str, keep_default_na=False)
+    path = response_path(request_path)
+
+    synthesize_response(request).to_csv(path, index=False)
+    print(f"Info: atmosfair stand-in: answered {len(request)} flights of {request_path} in {path}.")
+
+    return path
+
+
+def answer_open_requests():
+    return [answer_request(path)
+            for path in sorted(glob.glob(f"{output_folder}/to_atmosfair_*.csv"))
+            if not os.path.isfile(response_path(path))]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        for path in sys.argv[1:]:
+            answer_request(path)
+    else:
+        answer_open_requests()
@@ -0,0 +1,162 @@
+####
+# Persistent store for atmosfair responses.
+#
+# Re-reading every atmosfair response on each run gets slower with every shipment. Instead, each
+# response file is ingested once into a sqlite database next to the other cached data. Files are
+# tracked by content hash, so a run only pays for responses it hasn't seen before.
+#
+# Flights are unique on the key columns (q_keys in atmosfair.py). If a flight shows up again in a
+# later response, the later values replace the earlier ones.
+#
+# To rebuild the store from scratch (e.g. after removing a response file), just delete it.
+#
+# The request ledger (a separate database, so rebuilding the store keeps it) records which flights were
+# sent to atmosfair in which request file, and when. Entries stay open until a response with the flight
+# is ingested, so flights awaiting a response are not requested (and paid for) again.
+####
+import sqlite3
+import pandas as pd
+import os
+from cached_csv_from_xls import cached_data_dir
+
+store_path = f"{cached_data_dir}/atmosfair.sqlite"
+ledger_path = f"{cached_data_dir}/atmosfair-requests.sqlite"
+
+# Bump this whenever the layout of the store changes, to rebuild it from the responses.
+store_version = 1
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _columns(con):
+    return [row[1] for row in con.execute('PRAGMA table_info(emissions)')]
+
+
+####
+# Open the store, creating it if needed.
+# @columns: the columns every flight has (including the keys), so lookups always return them.
+# @keys: the columns identifying a flight.
+####
+def open_store(columns, keys, path=store_path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    con = sqlite3.connect(path)
+
+    if con.execute('PRAGMA user_version').fetchone()[0] != store_version:
+        con.executescript('DROP TABLE IF EXISTS emissions; DROP TABLE IF EXISTS files;')
+        con.execute(f'PRAGMA user_version = {store_version}')
+
+    # No column types: sqlite keeps floats as floats and strings as strings.
+    con.execute(
+        f"CREATE TABLE IF NOT EXISTS emissions ({', '.join(_quote(c) for c in columns)})")
+    con.execute(
+        f"CREATE UNIQUE INDEX IF NOT EXISTS emissions_keys ON emissions ({', '.join(_quote(k) for k in keys)})")
+    con.execute(
+        'CREATE TABLE IF NOT EXISTS files (hash TEXT PRIMARY KEY, path TEXT, rows INTEGER)')
+    con.commit()
+
+    return con
+
+
+def ingested_hashes(con):
+    return {row[0] for row in con.execute('SELECT hash FROM files')}
+
+
+####
+# Add the flights of one response file to the store, replacing flights we already had.
+# Columns the store doesn't know yet are added. The file is recorded in the same transaction,
+# so an interrupted run never leaves a half-ingested file behind.
+####
+def ingest(con, df, content_hash, path):
+    with con:
+        known = _columns(con)
+        for col in df.columns:
+            if col not in known:
+                con.execute(f'ALTER TABLE emissions ADD COLUMN {_quote(col)}')
+
+        values = df.astype(object).where(df.notna(), None).values.tolist()
+        con.executemany(
+            f"INSERT OR REPLACE INTO emissions ({', '.join(_quote(c) for c in df.columns)}) "
+            f"VALUES ({', '.join('?' * len(df.columns))})", values)
+        con.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?)',
+                    (content_hash, path, len(df)))
+
+
+# A temp table lookup_keys with the distinct rows of keys_df, to join with.
+def _create_keys_table(con, keys_df):
+    key_list = ', '.join(_quote(k) for k in keys_df.columns)
+
+    con.execute('DROP TABLE IF EXISTS temp.lookup_keys')
+    con.execute(f'CREATE TEMP TABLE lookup_keys ({key_list})')
+    con.executemany(
+        f"INSERT INTO lookup_keys VALUES ({', '.join('?' * len(keys_df.columns))})",
+        keys_df.drop_duplicates().values.tolist())
+
+    return key_list
+
+
+####
+# Look up the stored flights for the given keys (a frame with only the key columns).
+# Returns one row per flight found, with all stored columns.
+####
+def lookup(con, keys_df):
+    key_list = _create_keys_table(con, keys_df)
+
+    found = pd.read_sql_query(
+        f'SELECT emissions.* FROM emissions JOIN lookup_keys USING ({key_list})', con)
+    con.execute('DROP TABLE temp.lookup_keys')
+
+    return found
+
+
+####
+# Open the request ledger, creating it if needed.
+# @keys: the columns identifying a flight.
+####
+def open_ledger(keys, path=ledger_path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    con = sqlite3.connect(path)
+
+    key_list = ', '.join(_quote(k) for k in keys)
+    # answered_by is the response file which contained the flight, NULL while the request is open.
+    con.execute(
+        f'CREATE TABLE IF NOT EXISTS requests ({key_list}, request TEXT, requested_at TEXT, answered_by TEXT)')
+    con.execute(f'CREATE INDEX IF NOT EXISTS requests_keys ON requests ({key_list})')
+    con.commit()
+
+    return con
+
+
+# Record that the flights of keys_df were sent in request file `request` at `requested_at` (iso timestamp).
+def record_requests(con, keys_df, request, requested_at):
+    with con:
+        con.executemany(
+            f"INSERT INTO requests ({', '.join(_quote(k) for k in keys_df.columns)}, request, requested_at) "
+            f"VALUES ({', '.join('?' * (len(keys_df.columns) + 2))})",
+            [row + [request, requested_at] for row in keys_df.drop_duplicates().values.tolist()])
+
+
+####
+# The open requests for the given flights (a frame with only the key columns) which were sent at or after
+# `since` (iso timestamp). Returns the keys with request and requested_at, one row per request.
+####
+def open_requests(con, keys_df, since):
+    key_list = _create_keys_table(con, keys_df)
+
+    found = pd.read_sql_query(
+        f'SELECT {key_list}, request, requested_at FROM requests JOIN lookup_keys USING ({key_list}) '
+        'WHERE answered_by IS NULL AND requested_at >= ?', con, params=[since])
+    con.execute('DROP TABLE temp.lookup_keys')
+
+    return found
+
+
+# Close all open requests for the flights of keys_df, which were answered in response file `response`.
+def close_requests(con, keys_df, response):
+    with con:
+        key_list = _create_keys_table(con, keys_df)
+        con.execute(
+            f'UPDATE requests SET answered_by = ? WHERE answered_by IS NULL '
+            f'AND ({key_list}) IN (SELECT {key_list} FROM lookup_keys)', [response])
+        con.execute('DROP TABLE temp.lookup_keys')
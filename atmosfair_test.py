@@ -1,49 +1,74 @@
 import pandas as pd
-from df_to_list import df_to_list
 
-from atmosfair import atmos_def
+from atmosfair import atmos_def, q_keys
 
-from config import config
 
-originals_folder = config['General']['originals_folder']
+# The flight keys as merge_emissions compares them: iso date strings, and '' for anything undefined.
+def _flight_keys(df):
+    keys = df[q_keys].copy()
+    keys['leg_date'] = keys['leg_date'].dt.strftime('%Y-%m-%d')
 
-
-def has_atmos_leg(ref_leg):
-    return lambda test_leg: test_leg['from'] == ref_leg['from'] and test_leg['to'] == ref_leg['to'] and test_leg['flight_number'] == ref_leg['flight_number'] and test_leg['leg_date'] == ref_leg['leg_date'] and test_leg['class'] == ref_leg['class']
+    return keys.fillna('')
 
 
 ####
-# This tests the situation where there is no need for an atmosfair transfer.
+# Check that legs_with_ghg (see merge_emissions) covers all legs. Runs in linear time: the flights of
+# legs_with_ghg are hashed once, then every leg is looked up.
+#
+# Returns a report with:
+# - row and pax counts of both frames, which should be equal,
+# - without_emissions: flight keys of legs_with_ghg rows without emission data,
+# - unmatched: flight keys of legs which have no flight in legs_with_ghg.
+# Use coverage_issues to turn the report into messages.
 ####
-def atmosfair_test(legs, missing_filename, legs_with_ghg):
-    print(f'Testing atmosfair load.')
+def verify_atmosfair_coverage(legs, legs_with_ghg):
+    ghg_keys = _flight_keys(legs_with_ghg)
+    leg_keys = _flight_keys(legs)
 
-    assert missing_filename == None
-    # We have no leg marked as incomplete.
-    print('Checking overall numbers match ...', end=" ")
-    assert len(legs_with_ghg[legs_with_ghg[atmos_def['co2']].isna()]) == 0
-    assert legs_with_ghg['pax_count'].astype(
-        'int').sum() == legs['pax_count'].astype('int').sum()
-    assert legs_with_ghg.shape[0] == legs.shape[0]
-    print('done.')
+    ghg_flights = pd.MultiIndex.from_frame(ghg_keys)
+    matched = pd.MultiIndex.from_frame(leg_keys).isin(ghg_flights)
+
+    no_emissions = legs_with_ghg[atmos_def['co2']].isna().to_numpy()
+
+    return {
+        'rows': legs.shape[0],
+        'rows_with_ghg': legs_with_ghg.shape[0],
+        'pax_count': legs['pax_count'].astype('int').sum(),
+        'pax_count_with_ghg': legs_with_ghg['pax_count'].astype('int').sum(),
+        'without_emissions': ghg_keys[no_emissions].drop_duplicates(),
+        'unmatched': leg_keys[~matched].drop_duplicates()
+    }
 
-    print('Checking if every leg finds a match inside the atmosfair cache ...', end=" ")
-    legs_copy = pd.DataFrame.copy(legs)
-    legs_copy['leg_date'] = legs_copy['leg_date'].dt.strftime('%Y-%m-%d')
-    legs_copy.fillna('', inplace=True)
-    legs_list = df_to_list(legs_copy)
-    atmosfair_list = df_to_list(legs_with_ghg)
 
-    hit_count = 0
+def coverage_issues(report):
+    issues = []
+    if report['rows'] != report['rows_with_ghg']:
+        issues.append(
+            f"atmosfair coverage: {report['rows']} legs, but {report['rows_with_ghg']} legs with emissions.")
+    if report['pax_count'] != report['pax_count_with_ghg']:
+        issues.append(
+            f"atmosfair coverage: pax count {report['pax_count']}, but {report['pax_count_with_ghg']} with emissions.")
+    if len(report['without_emissions']):
+        issues.append(
+            f"atmosfair coverage: {len(report['without_emissions'])} flights without emission data, e.g. "
+            f"{report['without_emissions'].iloc[0].to_dict()}")
+    if len(report['unmatched']):
+        issues.append(
+            f"atmosfair coverage: {len(report['unmatched'])} flights not found in the emission data, e.g. "
+            f"{report['unmatched'].iloc[0].to_dict()}")
 
-    for leg in legs_list:
+    return issues
+
+
+####
+# This tests the situation where there is no need for an atmosfair transfer.
+####
+def atmosfair_test(legs, missing_filenames, legs_with_ghg):
+    print(f'Testing atmosfair load.')
 
-        hit = list(filter(has_atmos_leg(leg), atmosfair_list))
-        if len(hit) == 0:
-            raise Exception(f"Miss for {leg}")
-        else:
-            hit_count += 1
+    assert not missing_filenames
 
-    # We want an atmosfair data hit for every leg in our original files.
-    assert(hit_count == len(legs_list))
+    issues = coverage_issues(verify_atmosfair_coverage(legs, legs_with_ghg))
+    if len(issues):
+        raise Exception('\n'.join(issues))
     print('done.')
@@ -1,11 +1,9 @@
 import pandas as pd
-import datetime as dt
-from parse_number import parse_number
-from cached_csv_from_xls import get_or_cache
-from trip_id import create_assign_trip
-import math
-import re
+import numpy as np
+from cached_csv_from_xls import read_cached_many
+from functools import cache
 from excel_writer_formatted import to_excel
+from util import file_timestamp
 
 from config import config
 
@@ -35,6 +33,12 @@ def _resolve_bta_department(bta_dep):
 bta_fare_class_map = {'F': 'F', 'Y': 'Y', 'C': 'B', 'W': 'P'}
 
 originals_folder = config['General']['originals_folder']
+output_folder = config['General']['output_folder']
+min_year = config['legs']['bta_min_year']
+process_cancellations = config['legs']['bta_process_cancellations']
+
+# Columns identifying a booked leg and its cancellation, see _process_cancellations
+cancellation_keys = ['km', 'Pax', 'From Destination', 'To Destination']
 
 
 default_cols = {
@@ -52,11 +56,8 @@ def add_default_cols(legs):
         legs[key] = value
 
 
-print('TODO: Add Cost from first row always, perhaps Error on cost 0')
-
-# Reading excel works (see requirements.txt) but is super slow.
-bta_csv_paths = [get_or_cache(
-    f"{originals_folder}/{item}") for item in config['legs']['bta']]
+# Reading excel works (see requirements.txt) but is super slow. read_cached caches the sheets.
+bta_paths = [f"{originals_folder}/{item}" for item in config['legs']['bta']]
 
 # unused..
 _seconds_in_day = 24 * 60 * 60
@@ -67,220 +68,302 @@ def _days_difference(date1, date2):
     return divmod(difference.days * _seconds_in_day + difference.seconds, 60)
 
 
-def _get_defined_routing_cols(row):
-    # Slice all legs
-    legs = row["Routing 1":"Routing 12"]
-    # turn them into array, only take those that are defined.
-    legs = [col for (j, col) in enumerate(legs) if pd.notna(legs[j])]
-    return legs
-
-
-def _to_float(str):
-    return float(re.sub("[\.']", '', str))
-
-
-def _sorted_rows(df):
-    # row['Dossier No'] + \
-    def sort(row): return \
-        row['Pax'] + \
-        str(-math.copysign(1, _to_float(
-            row['Airline Km']))) + pd.to_datetime(_extract_routing_columns(row['Routing 1'])['leg_date'], dayfirst=True).strftime('%Y-%m-%d') + \
-        row['Ticket N°2']
-
-    sorted = df.iloc[df.apply(sort, axis=1).argsort()]
-
-    return sorted
-
-
-def _find_positive_match(df, neg_row):
-    # Identify what we're looking for.
-    km = abs(_to_float(neg_row['Airline Km']))
-
-    def mask(row):
-        # since out/inbound leg pairs have same everything, get 2 hits often. We try narrowing down by
-        # adding the check for 'From Destination'
-        # Also, ticket numbers or similar can be all different between booking and cancellation.
-        # row['Ticket N°2'] == neg_row['Ticket N°2'] and \
-        # got better than this: same all of routing.
-        # _extract_routing_columns(row['Routing 1'])['leg_date'] == _extract_routing_columns(neg_row['Routing 1'])['leg_date'] and \
-        # But: We are checking first routing col equality only because we got some trips where only a single leg is cancelled: 3056119942
-        # Sometimes: multiple single-leg cancellations for 1 multi-leg trip: 3056119943
-        # I can't use Departure Date col for a match: 5910418675
-        # Letting this be for a min:
-        # _get_defined_routing_cols(neg_row)[0] in _get_defined_routing_cols(row) and \
-        # Sometimes I have seen flights canceled from one dep and re-booked in another (3270120403). Can't do anything about this.
-        return _to_float(row['Airline Km']) == km and \
-            row['Pax'] == neg_row['Pax'] and \
-            row['To Destination'] == neg_row['To Destination'] and \
-            row['From Destination'] == neg_row['From Destination']
-        # _days_difference(_extract_routing_columns(row['Routing 1'])['leg_date'], _extract_routing_columns(neg_row['Routing 1'])['leg_date']) < 11
-
-    match = df[df.apply(mask, axis=1)]
-
-    if match.shape[0] == 0:
-        print(
-            f"No booked leg found for cancelled leg with Ticket N°2 {neg_row['Ticket N°2']}, Pax {neg_row['Pax']}, From {neg_row['From Destination']}, To {neg_row['To Destination']}")
-        return None
-
-    # Sometimes we just can't distinguish trips.. (e.g. Ticket N°2: 1694912232). Then, pick any
-    # if match.shape[0] > 1:
-    #     raise Exception(f"Multiple booked matches found for cancelled leg {neg_row.to_string()}")
+####
+# Cancellations are rows with negative 'Airline Km'. Each one is paired with a booked (positive) row.
+# Like every row of a booking, a booked row stands for one leg of the booking (see _cancelled_legs).
+# Cancellations without a booked row are reported.
+#
+# A booked row matches if km, Pax, 'From Destination' and 'To Destination' are the same:
+# - since out/inbound leg pairs have same everything, we get 2 hits often. We narrow down by
+#   checking 'From Destination' too.
+# - ticket numbers or similar can be all different between booking and cancellation.
+# - we can't use the routing: we got some trips where only a single leg is cancelled (3056119942),
+#   sometimes multiple single-leg cancellations for 1 multi-leg trip (3056119943).
+# - we can't use the Departure Date col for a match either (5910418675).
+# - sometimes flights are canceled from one dep and re-booked in another (3270120403). Can't do anything about this.
+# Sometimes we just can't distinguish trips (e.g. Ticket N°2: 1694912232). Then, the earliest booking wins.
+#
+# Rather than scanning the frame per cancellation, we number the bookings and the cancellations
+# of every key in frame order: the n-th cancellation of a key cancels the n-th unmatched booking.
+# This is the same as pairing each cancellation, in order, with the earliest unmatched booking.
+#
+# Rows are not removed here: that would break grouping the rows into bookings by their leg count.
+# Expects a unique index. Returns [mask of cancelled booked rows, unmatched cancellations].
+####
+def _process_cancellations(df):
+    km = df['Airline Km'].str.replace(r"[.']", '', regex=True).astype(float)
 
-    return match.head(1).index
+    keyed = df[cancellation_keys[1:]].copy()
+    keyed['km'] = km.abs()
+    keyed['is_neg'] = km < 0
 
+    # NaN keys never match anything
+    keyed = keyed[keyed[cancellation_keys].notna().all(axis=1)]
+    keyed['nth'] = keyed.groupby(cancellation_keys + ['is_neg']).cumcount()
 
-def _process_cancellations(df):
-    for index, row in df.iterrows():
-        # If this is negative, it's a cancellation
-        km = _to_float(row['Airline Km'])
-        if km >= 0:
-            continue
+    bookings = keyed[~keyed['is_neg']].reset_index()
+    cancellations = keyed[keyed['is_neg']].reset_index()
+    pairs = pd.merge(cancellations, bookings, how='inner',
+                     on=cancellation_keys + ['nth'], suffixes=(' cancelled', ' booked'))
 
-        # Found a cancellation.
-        positive_row_index = _find_positive_match(df, row)
+    index_col = bookings.columns[0]
+    cancelled = df.index.isin(pairs[f'{index_col} booked'])
+    unmatched = df[(km < 0) & ~df.index.isin(pairs[f'{index_col} cancelled'])]
 
-        df.drop(index, inplace=True)
+    return [cancelled, unmatched]
 
-        if positive_row_index is not None:
-            df.drop(positive_row_index, inplace=True)
 
-    return df
+def _report_cancellations(unmatched):
+    if not len(unmatched):
+        print('Info: all bta cancellations matched a booked leg.')
+        return
 
+    report_cols = [col for col in ['Ticket N°2', 'Pax', 'From Destination', 'To Destination',
+                                   'Airline Km', 'Departure Date'] if col in unmatched.columns]
+    path = f'{output_folder}/bta_unmatched_cancellations_{file_timestamp()}.xlsx'
+    to_excel(unmatched[report_cols], path, index=False)
 
-def _bta_fare_class_to_canonical(cls=''):
-    if cls == '':
-        return cls
-
-    return bta_fare_class_map[cls].upper()
+    print(
+        f'Info: no booked leg found for {len(unmatched)} bta cancellations, see {path}')
 
 
-# Routing columns definitions to use in _extract_routing_columns
+# The '|'-separated entries of a routing string, see _parse_routing
 routing_columns = ['from', 'to', 'airline',
                    'nr', 'class orig', 'class', 'leg_date']
 
 
-def _extract_routing_columns(routing_str):
-    entries = [e.strip() for e in routing_str.split('|')]
-
-    dic = dict(zip(routing_columns, entries))
+# Columns created by _parse_routing
+routing_leg_columns = ['from', 'to', 'class', 'leg_date', 'flight_number']
+# Leg dates inside the routing strings, e.g. 24.03.2019
+routing_date_format = '%d.%m.%Y'
 
-    new_dic = {key: dic[key] for key in ['from', 'to']}
-    new_dic['class'] = _bta_fare_class_to_canonical(dic['class'])
-    new_dic['leg_date'] = pd.to_datetime(dic['leg_date'], dayfirst=True)
-    new_dic['flight_number'] = dic['airline'] + dic['nr']
 
-    # and convert stuff to upper case
-    new_dic['class'] = new_dic['class'].upper()
-    new_dic['flight_number'] = new_dic['flight_number'].upper()
-    new_dic['from'] = new_dic['from'].upper()
-    new_dic['to'] = new_dic['to'].upper()
+# Vectorized parse_number
+def _to_km(series):
+    return pd.to_numeric(series.str.replace("'", '', regex=False))
 
-    # if dic['class orig'] and dic['class orig'] not in classes[dic['class']]:
-    #     classes[dic['class']].append(dic['class orig'])
-    # if not dic['class orig'] and dic['class'] not in classes['unknown']:
-    #     classes['unknown'].append(dic['class'])
 
-    # print(classes)
-    return new_dic
+####
+# All defined routing entries in long form: one row per leg, in the original row order, with
+# 'row' (position of the bta row) and 'position' (index of the leg within that row's routing).
+####
+def _routing_legs(routing):
+    # stack() skips undefined routing columns.
+    stacked = routing.reset_index(drop=True).stack()
 
+    return pd.DataFrame({
+        'row': stacked.index.get_level_values(0),
+        'position': stacked.groupby(level=0).cumcount().to_numpy(),
+        'routing': stacked.to_numpy()
+    })
 
-# Correctly parse dates (used for filtering only 2017+ years afterwards)
-all_years = [pd.read_csv(path, dtype=str, parse_dates=[
-    'Departure Date'], dayfirst=True) for path in bta_csv_paths]
 
-bta_orig = pd.concat(all_years, axis=0)
+####
+# BTA lists a booking with n legs as n rows which all repeat the full routing.
+# Returns a mask of the first row of every booking.
+# Since the number of rows of a booking is only known from its first row, this is
+# inherently sequential - but it only walks the leg counts, not the frame.
+####
+def _booking_starts(leg_counts):
+    is_start = np.zeros(len(leg_counts), dtype=bool)
+    next_index = 0
 
+    for index, count in enumerate(leg_counts):
+        if index >= next_index:
+            is_start[index] = True
+            next_index = index + count
 
-#########
-# 1. Fix up the travel dataset before processing it.
-#########
+    return is_start
 
-# Remove empty rows
-bta_orig = bta_orig.loc[bta_orig['Departure Date'].notna()]
 
-# Fixing dates is not needed anymore.
-# bta_orig["Departure Date"] = pd.to_datetime(bta_orig["Departure Date"], dayfirst=True)
-# Limit the records counted
-bta_orig = bta_orig[bta_orig['Departure Date'].dt.year >= 2017]
+####
+# The (booking, position) of the legs the cancelled rows stand for: the n-th row of a booking is its n-th leg.
+####
+def _cancelled_legs(cancelled_rows, is_start, booking):
+    rows = np.flatnonzero(cancelled_rows)
+    start_rows = np.flatnonzero(is_start)
 
-# to_excel(bta_orig, 'output/bta_precancel.xlsx', index=False)
-# bta_orig = _process_cancellations(bta_orig)
-# to_excel(bta_orig, 'output/bta_postcancel.xlsx', index=False)
-# pandas always keeps the old indices in mutated datasets unless they are reset.
-# Since we are making index-based calculations in the iterrows() call, we need a reset.
-bta_orig.reset_index(inplace=True)
+    return pd.MultiIndex.from_arrays(
+        [booking[rows], rows - start_rows[booking[rows]]], names=['booking', 'position'])
 
-# sort the dataset
-# bta_orig = _sorted_rows(bta_orig)
 
-# Create a trip increment function without any dependencies: each call creates a new trip.
-assign_trip = create_assign_trip()
+# All rows of a booking need to have the same routing as its first row.
+def _check_duplicate_rows(legs_long, leg_counts, booking):
+    # Position of the first row of the booking, for every row.
+    first_row = pd.Series(np.arange(len(booking))).groupby(
+        booking).transform('first').to_numpy()
 
-#########
-# 2. Copy relevant data from resulting original dataset
-#########
+    count_mismatch = leg_counts != leg_counts[first_row]
 
-# Future: collect PID Sales Amount? Note additional "Price" tag.
-bta_list = []
-next_index = 0
-ref_index = 0
-check_cols = []
+    legs = legs_long.assign(first_row=first_row[legs_long['row']])
+    reference = legs_long.rename(
+        columns={'row': 'first_row', 'routing': 'reference'})
+    compared = pd.merge(legs, reference, how='left',
+                        on=['first_row', 'position'])
+    leg_mismatch = compared['routing'] != compared['reference']
 
-neg_count = 0
+    bad_rows = np.union1d(np.flatnonzero(count_mismatch),
+                          compared.loc[leg_mismatch, 'row'])
 
-for index, row in bta_orig.iterrows():
-    is_neg = parse_number(row['Airline Km']) < 0
-    if is_neg:
-        neg_count += 1
+    if len(bad_rows):
+        index = bad_rows[0]
+        ref_index = first_row[index]
+        print(f'reference record (row {ref_index + 2})')
+        print(legs_long.loc[legs_long['row'] == ref_index, 'routing'].tolist())
+        print(f'new record (row {index + 2})')
+        print(legs_long.loc[legs_long['row'] == index, 'routing'].tolist())
+        raise Exception('Records should be same but are not')
 
-    if (index < next_index):
-        dupes = row["Routing 1":"Routing 12"]
-        dupes = [col for (j, col) in enumerate(dupes) if pd.notna(dupes[j])]
 
-        if len(dupes) != len(legs) or len([col for (j, col) in enumerate(dupes) if legs[j] != col]):
-            print(f'reference record (row {ref_index + 2})')
-            print(legs)
-            print(f'new record (row {index + 2})')
-            print(dupes)
-            raise Exception('Records should be same but are not')
+# Parse a series of routing strings into legs (see routing_leg_columns).
+def _parse_routing(routing):
+    parts = routing.str.split('|', expand=True)
 
-        continue
+    if parts.shape[1] < len(routing_columns) or parts.iloc[:, :len(routing_columns)].isna().any().any():
+        raise Exception(
+            f'BTA routing with less than {len(routing_columns)} entries: {routing[parts.isna().any(axis=1)].iloc[0]}')
 
-    legs = _get_defined_routing_cols(row)
+    entries = {col: parts[i].str.strip()
+               for i, col in enumerate(routing_columns)}
 
-    dic = {}
-    dic['pax_name'] = row['Pax']
-    # pax_count is used for
-    # i) Creating the one_off cumulative leg list customer sent to atmosfair for their analysis pdf.
-    # ii) For the atmosfair_test assert check to count overall legs.
-    dic['pax_count'] = '1'
-    # NOTE: We'll save this into the bta df but it is only used to show this to the
-    # user that manually matches pax names to similar HR records.
-    # If there is no match (NN) and people are considered guests,
-    # they are NOT assigned a department as our strategy currently is
-    # "assign employee departments", not "assign sponsoring department"
-    dic['booking department'] = _resolve_bta_department(row['Department'])
-    dic['trip_id'] = assign_trip()
-    # dic['km'] = parse_number(row['Airline Km']) / len(legs)
+    fare_class = entries['class']
+    canonical_class = fare_class.map(bta_fare_class_map)
+    unknown_classes = fare_class[(fare_class != '') &
+                                 canonical_class.isna()].unique()
+    if len(unknown_classes):
+        raise Exception(
+            f"BTA fare class {', '.join(unknown_classes)} occurring first time; add it to bta_fare_class_map.")
+
+    try:
+        leg_date = pd.to_datetime(
+            entries['leg_date'], format=routing_date_format)
+    except ValueError:
+        # Not every export sticks to the format; guessing is slower but was what we always did.
+        leg_date = pd.to_datetime(entries['leg_date'], dayfirst=True)
+
+    return pd.DataFrame({
+        'from': entries['from'].str.upper(),
+        'to': entries['to'].str.upper(),
+        'class': canonical_class.where(fare_class != '', '').str.upper(),
+        'leg_date': leg_date,
+        'flight_number': (entries['airline'] + entries['nr']).str.upper()
+    })
+
+
+####
+# Reads and converts all bta legs. This is only done on first use, and then memoized.
+# Call invalidate_bta_legs to re-read the files.
+####
+@cache
+def _load_bta_legs():
+    print('TODO: Add Cost from first row always, perhaps Error on cost 0')
+
+    # Correctly parse dates (used for filtering only min_year+ years afterwards)
+    # Rows before min_year are already skipped while streaming the xls into the cache.
+    all_years = read_cached_many(
+        bta_paths, parse_dates=['Departure Date'], dayfirst=True, min_year=('Departure Date', min_year))
+
+    bta_orig = pd.concat(all_years, axis=0)
+
+    #########
+    # 1. Fix up the travel dataset before processing it.
+    #########
+
+    # Remove empty rows
+    bta_orig = bta_orig.loc[bta_orig['Departure Date'].notna()]
+
+    # Fixing dates is not needed anymore.
+    # bta_orig["Departure Date"] = pd.to_datetime(bta_orig["Departure Date"], dayfirst=True)
+    # Limit the records counted
+    bta_orig = bta_orig[bta_orig['Departure Date'].dt.year >= min_year]
+
+    # pandas always keeps the old indices in mutated datasets unless they are reset.
+    # Since we are making position-based calculations below, we need a reset.
+    bta_orig.reset_index(inplace=True, drop=True)
+
+    cancelled_rows = np.zeros(len(bta_orig), dtype=bool)
+    if process_cancellations:
+        [cancelled_rows, unmatched_cancellations] = _process_cancellations(bta_orig)
+        _report_cancellations(unmatched_cancellations)
+
+    # Cancellation rows never become legs. Drop them before grouping rows into bookings: a cancellation
+    # of a single leg may repeat the whole routing, which would throw off the leg counts.
+    is_neg = (_to_km(bta_orig['Airline Km']) < 0).to_numpy()
+    neg_count = is_neg.sum()
+    bta_orig = bta_orig[~is_neg].reset_index(drop=True)
+    cancelled_rows = cancelled_rows[~is_neg]
+
+    #########
+    # 2. Copy relevant data from resulting original dataset
+    #########
+
+    # Future: collect PID Sales Amount? Note additional "Price" tag.
+    routing = bta_orig.loc[:, 'Routing 1':'Routing 12']
+    leg_counts = routing.notna().sum(axis=1).to_numpy()
+
+    # All defined routing entries in long form, one per leg, in row order.
+    legs_long = _routing_legs(routing)
+
+    is_start = _booking_starts(leg_counts)
+    booking = is_start.cumsum() - 1
+
+    _check_duplicate_rows(legs_long, leg_counts, booking)
+
+    starts = bta_orig[is_start]
+
+    # Raises for departments we don't know yet.
+    for dep in starts['Department'].unique():
+        _resolve_bta_department(dep)
+
+    bookings = pd.DataFrame({
+        'booking': booking[is_start],
+        'pax_name': starts['Pax'].to_numpy(),
+        # pax_count is used for
+        # i) Creating the one_off cumulative leg list customer sent to atmosfair for their analysis pdf.
+        # ii) For the atmosfair_test assert check to count overall legs.
+        'pax_count': '1',
+        # NOTE: We'll save this into the bta df but it is only used to show this to the
+        # user that manually matches pax names to similar HR records.
+        # If there is no match (NN) and people are considered guests,
+        # they are NOT assigned a department as our strategy currently is
+        # "assign employee departments", not "assign sponsoring department"
+        'booking department': starts['Department'].map(_deps).to_numpy(),
+        # Every booking is a new trip.
+        'trip_id': np.arange(int(is_start.sum()))
+    })
+
+    # Only the legs of the first row of each booking; the rest are duplicates.
+    booked_legs = legs_long[is_start[legs_long['row']]]
+    booked_legs = booked_legs.assign(
+        booking=booking[booked_legs['row']]).reset_index(drop=True)
+    # Drop the legs cancelled rows stand for.
+    cancelled_legs = _cancelled_legs(cancelled_rows, is_start, booking)
+    booked_legs = booked_legs[~pd.MultiIndex.from_frame(
+        booked_legs[['booking', 'position']]).isin(cancelled_legs)].reset_index(drop=True)
+    booked_legs = pd.concat(
+        [booked_legs, _parse_routing(booked_legs['routing'])], axis=1)
+
+    bta_final = pd.merge(bookings, booked_legs, how='inner', on='booking')
+    bta_final = bta_final[['pax_name', 'pax_count', 'booking department', 'trip_id'] +
+                          list(routing_leg_columns)].reset_index(drop=True)
+
+    if neg_count and not process_cancellations:
+        print(
+            f'dataset has {neg_count} cancellations, the legs they cancel are left as trips. Check those manually.')
 
-    route_list = [_extract_routing_columns(row) for row in legs]
-
-    records = [{**dic, **route_info} for route_info in route_list]
+    add_default_cols(bta_final)
 
-    if not is_neg:
-        bta_list.extend(records)
-    ref_index = index
-    next_index = index + len(legs)
+    return bta_final
 
-if neg_count:
-    print(
-        f'dataset has {neg_count} cancellations left as trips. Check those manually.')
 
-# pd.from_records?
-bta_final = pd.DataFrame(bta_list)
+def invalidate_bta_legs():
+    _load_bta_legs.cache_clear()
 
-add_default_cols(bta_final)
 
+# @first_trip_id: trip ids of these legs start here, see trip_id.py
+def bta_legs_import(first_trip_id=0):
+    bta_legs = _load_bta_legs()
+    if not first_trip_id:
+        return bta_legs
 
-def bta_legs_import():
-    return bta_final
+    return bta_legs.assign(trip_id=bta_legs['trip_id'] + first_trip_id)
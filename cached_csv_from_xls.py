@@ -1,32 +1,223 @@
 # XLS parsing is super slow.
-# So given a name, first check if the csv is available, else create a csv "cache"
-# for the provided xls, and return the file handle to it.
-# We are not directly loading it here because the caller might want to provide
-# custom options.
+# So given a name, first check if a cached copy of the sheet is available, else create a parquet
+# "cache" for the provided xls, and return the path to it.
+#
+# The cache is validated against a manifest (see `manifest_path`) which records size, mtime and a
+# content hash of each source workbook. A re-exported workbook therefore invalidates its cached sheets
+# automatically. Size/mtime are only a fast path: if they changed, we fall back to comparing the hash,
+# so merely touching or copying a file does not trigger a new conversion.
+#
+# Use `read_cached` to load a sheet. It accepts the read_csv options our callers use, so the parquet
+# cache is a drop-in replacement for the csv cache we had before.
+#
+# On a cold cache, converting is by far the slowest step of a run. The `*_many` variants therefore
+# convert all stale workbooks of a batch in parallel worker processes, opening each workbook only once
+# even if several of its sheets are needed.
+#
+# Sheets are streamed into the cache in batches of rows (see stream_xls.py), optionally skipping rows
+# older than a given year while reading. Such filtered sheets are cached separately from unfiltered ones.
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import os
 import os.path
-import pathlib
+import json
 import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from util import file_hash
+from stream_xls import open_workbook, iter_sheet_batches
 
 cached_data_dir = 'data-cached'
+manifest_path = f"{cached_data_dir}/manifest.json"
 
+# Bump this whenever the content or layout of cached files changes, to drop all existing entries.
+cache_version = 3
 
-def cached_csv_from_xls(xls_path, sheet_name):
+# Number of rows held in memory while streaming a sheet into the cache.
+batch_size = 10000
+
+# The values read_csv treats as NaN by default. The csv cache relied on these, so we keep them.
+_csv_na_values = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND',
+                  '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'n/a', 'nan', 'null']
+
+
+def _read_manifest():
+    if not os.path.isfile(manifest_path):
+        return {}
+
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def _write_manifest(manifest):
+    # Write to a temp file first, so an interrupted run can't leave a corrupt manifest behind.
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+# @min_year: see stream_xls.iter_sheet_batches
+def _cache_key(xls_path, sheet_name, min_year=None):
+    key = f"{os.path.normpath(xls_path)}[{sheet_name}]"
+    if min_year:
+        key += f" {min_year[0]} >= {min_year[1]}"
+
+    return key
+
+
+def _cached_sheet_path(xls_path, sheet_name, min_year=None):
     filename = os.path.basename(xls_path)
     basename = os.path.splitext(filename)[0]
-    # dirname = os.path.dirname(xls_path)
+    suffix = f"-from{min_year[1]}" if min_year else ''
+
+    return f"{cached_data_dir}/{basename}-{sheet_name}{suffix}.parquet"
+
+
+def _source_stat(xls_path):
+    stat = os.stat(xls_path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+####
+# Check whether the manifest entry still describes the current source workbook.
+# Returns the (possibly refreshed) entry if the cache is valid, None otherwise.
+####
+def _validated_entry(entry, xls_path):
+    if entry is None or entry.get('version') != cache_version:
+        return None
+
+    if not os.path.isfile(entry['cached_path']):
+        return None
+
+    stat = _source_stat(xls_path)
+    if stat['size'] == entry['size'] and stat['mtime'] == entry['mtime']:
+        return entry
+
+    # Size or mtime changed: only the content hash can tell whether the data changed.
+    if stat['size'] != entry['size'] or file_hash(xls_path) != entry['hash']:
+        return None
+
+    return {**entry, **stat}
+
+
+# Stream a sheet into a parquet file batch by batch. All columns are strings, as with
+# read_excel(dtype=str, na_filter=False). Returns the number of rows written.
+def _stream_sheet(workbook, sheet_name, cached_path, min_year):
+    batches = iter_sheet_batches(workbook, sheet_name, batch_size, min_year)
+    columns = next(batches)
+    schema = pa.schema([(col, pa.string()) for col in columns])
+
+    rows = 0
+    with pq.ParquetWriter(cached_path, schema) as writer:
+        for batch in batches:
+            # Transpose the row batch into columns.
+            arrays = [pa.array(values, type=pa.string())
+                      for values in zip(*batch)]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            rows += len(batch)
+
+        # Make sure even an empty sheet ends up as a readable file with all columns.
+        if rows == 0:
+            writer.write_table(schema.empty_table())
+
+    return rows
+
+
+####
+# Convert the given sheets of a single workbook, opening the workbook only once.
+# This runs inside worker processes, so it must not touch the manifest.
+# Returns the manifest entries per sheet name and the time spent.
+####
+def _convert_workbook(xls_path, sheet_names, min_year=None):
+    start = time.perf_counter()
+    stat = _source_stat(xls_path)
+    content_hash = file_hash(xls_path)
+
+    entries = {}
+    workbook = open_workbook(xls_path)
+    try:
+        for sheet_name in sheet_names:
+            cached_path = _cached_sheet_path(xls_path, sheet_name, min_year)
+            rows = _stream_sheet(workbook, sheet_name, cached_path, min_year)
 
-    csv_name = f"{basename}-{sheet_name}.csv"
+            entries[sheet_name] = {
+                'version': cache_version,
+                'source': xls_path,
+                'sheet': sheet_name,
+                'min_year': list(min_year) if min_year else None,
+                'cached_path': cached_path,
+                'rows': rows,
+                **stat,
+                'hash': content_hash
+            }
+    finally:
+        workbook.close()
 
-    cached_csv_path = f"{cached_data_dir}/{csv_name}"
+    return [entries, time.perf_counter() - start]
 
-    # If the corresponding csv does not exist, create it
-    if not os.path.isfile(cached_csv_path):
-        # na_filter prevents the department NULL to be read as NaN.
-        data_xls = pd.read_excel(xls_path, sheet_name, index_col=None, dtype=str, na_filter=False)
-        data_xls.to_csv(cached_csv_path, encoding='utf-8', index=False)
 
-    return cached_csv_path
+####
+# Make sure all (xls_path, sheet_name) pairs have a valid cache entry and return their cached paths.
+# Stale workbooks are converted in parallel when there is more than one.
+#
+# NOTE: Platforms that spawn worker processes (rather than fork, as on Linux) re-import the __main__
+# module in every worker. Scripts calling this must keep their work behind an `if __name__ == '__main__'` guard,
+# as app.py does.
+####
+def cached_sheets_from_xls(xls_sheets, max_workers=None, min_year=None):
+    os.makedirs(cached_data_dir, exist_ok=True)
+
+    manifest = _read_manifest()
+    changed = False
+
+    # Group stale sheets by workbook, so every workbook is opened once.
+    stale = {}
+    for xls_path, sheet_name in xls_sheets:
+        key = _cache_key(xls_path, sheet_name, min_year)
+        entry = _validated_entry(manifest.get(key), xls_path)
+
+        if entry is None:
+            sheets = stale.setdefault(xls_path, [])
+            if sheet_name not in sheets:
+                sheets.append(sheet_name)
+        elif manifest[key] != entry:
+            # Persist refreshed mtimes, so the next run hits the fast path again.
+            manifest[key] = entry
+            changed = True
+
+    if len(stale) == 1:
+        [(xls_path, sheet_names)] = stale.items()
+        results = [(xls_path, _convert_workbook(
+            xls_path, sheet_names, min_year))]
+    elif len(stale) > 1:
+        workers = min(len(stale), max_workers or os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {xls_path: executor.submit(_convert_workbook, xls_path, sheet_names, min_year)
+                       for xls_path, sheet_names in stale.items()}
+            results = [(xls_path, future.result())
+                       for xls_path, future in futures.items()]
+    else:
+        results = []
+
+    for xls_path, [entries, seconds] in results:
+        print(
+            f"Info: cached {xls_path} ({', '.join(entries)}) in {seconds:.1f}s")
+        for sheet_name, entry in entries.items():
+            manifest[_cache_key(xls_path, sheet_name, min_year)] = entry
+        changed = True
+
+    if changed:
+        _write_manifest(manifest)
+
+    return [manifest[_cache_key(xls_path, sheet_name, min_year)]['cached_path']
+            for xls_path, sheet_name in xls_sheets]
+
+
+def cached_sheet_from_xls(xls_path, sheet_name, min_year=None):
+    return cached_sheets_from_xls([(xls_path, sheet_name)], min_year=min_year)[0]
 
 
 # Check if name ends with csv..
@@ -53,16 +244,67 @@ def parse_xls_path(path):
     return [f"{m.group(1)}{m.group(2)}", m.group(3)]
 
 
-# If we provide an excel path, create a cached csv and return its path.
-# We can also use a notation to indicate sheet names: 'path/to/[name.xlsx]sheet name'
-# If we provide an csv path: just return it
-def get_or_cache(path):
-    if (is_csv(path)):
-        return path
+def _parse_xls_sheet(path):
     [xls_path, sheet_name] = parse_xls_path(path)
 
     # Quality check.
     if not '.xls' in os.path.splitext(path)[1].casefold():
         raise Exception(f"Unsupported: Neither csv nor xls(x): {path}")
 
-    return cached_csv_from_xls(xls_path, sheet_name)
+    return (xls_path, sheet_name)
+
+
+# If we provide an excel path, create a cached parquet file and return its path.
+# We can also use a notation to indicate sheet names: 'path/to/[name.xlsx]sheet name'
+# If we provide an csv path: just return it
+# @min_year: optional (column name, year) tuple to skip older rows while caching.
+def get_or_cache(path, min_year=None):
+    return get_or_cache_many([path], min_year=min_year)[0]
+
+
+# Same as get_or_cache, for a list of paths. Stale workbooks are converted in parallel.
+def get_or_cache_many(paths, max_workers=None, min_year=None):
+    xls_sheets = [_parse_xls_sheet(path)
+                  for path in paths if not is_csv(path)]
+    cached_paths = iter(cached_sheets_from_xls(
+        xls_sheets, max_workers, min_year))
+
+    return [path if is_csv(path) else next(cached_paths) for path in paths]
+
+
+####
+# Load a csv or a (cached) xls sheet into a frame of strings.
+# The options mirror the read_csv ones: NaN handling, date parsing and column selection
+# behave as if the sheet had been loaded from a csv with dtype=str.
+# @min_year: optional (column name, year) tuple. Rows with no date or a date before that year are skipped.
+####
+def read_cached(path, usecols=None, parse_dates=None, dayfirst=False, na_filter=True, min_year=None):
+    return _read_cached_path(path, get_or_cache(path, min_year), usecols, parse_dates, dayfirst, na_filter, min_year)
+
+
+# Same as read_cached, for a list of paths. Stale workbooks are converted in parallel.
+def read_cached_many(paths, usecols=None, parse_dates=None, dayfirst=False, na_filter=True, min_year=None):
+    return [_read_cached_path(path, cached_path, usecols, parse_dates, dayfirst, na_filter, min_year)
+            for path, cached_path in zip(paths, get_or_cache_many(paths, min_year=min_year))]
+
+
+def _read_cached_path(path, cached_path, usecols, parse_dates, dayfirst, na_filter, min_year):
+    if is_csv(path):
+        df = pd.read_csv(path, dtype=str, usecols=usecols, parse_dates=parse_dates,
+                         dayfirst=dayfirst, na_filter=na_filter)
+        # csv files are not cached, so filter after loading.
+        if min_year:
+            years = pd.to_datetime(
+                df[min_year[0]], dayfirst=True, errors='coerce').dt.year
+            df = df[years >= min_year[1]]
+        return df
+
+    df = pd.read_parquet(cached_path, columns=usecols)
+
+    if na_filter:
+        df = df.mask(df.isin(_csv_na_values), np.nan)
+
+    for col in parse_dates or []:
+        df[col] = pd.to_datetime(df[col], dayfirst=dayfirst)
+
+    return df
@@ -0,0 +1,48 @@
+####
+# Canonical spelling of person names, for comparing names from different sources.
+#
+# - Separators (, - . / and whitespace) become a single space each.
+# - Umlauts written as ae, oe, ue are treated as ä, ö, ü.
+# - Accents and umlauts are removed: 'Fäs' and 'Faes' both become 'Fas'.
+#
+# The same names show up in every run (and often many times per run), so results are memoized per
+# raw name, up to memo_size names. Use canonicalize_names for a whole Series: every distinct name is only
+# converted once.
+####
+import unicodedata
+import re
+from functools import lru_cache
+
+# Keep separators as the letters on each side should not become neighbors in a n-gram
+_separators = re.compile(r'[,-./]|\s')
+# Need to convert ae => ä first, then normalize ä -> a.
+_umlaut_equivalents = {'ae': 'ä', 'oe': 'ö', 'ue': 'ü'}
+_umlauts = re.compile('|'.join(_umlaut_equivalents))
+
+
+# A str.translate table which removes accents. Entries are computed on first use of a character.
+class _AccentTable(dict):
+    def __missing__(self, codepoint):
+        # This not only removes umlauts, but also accents.
+        stripped = ''.join(c for c in unicodedata.normalize('NFD', chr(codepoint))
+                           if not unicodedata.category(c) == 'Mn')
+        self[codepoint] = stripped
+        return stripped
+
+
+_accent_table = _AccentTable()
+
+# Several times the names of an HR roster and a few years of BTA travellers.
+memo_size = 100000
+
+
+@lru_cache(maxsize=memo_size)
+def canonicalize_name(name):
+    name = _separators.sub(' ', name)
+    name = _umlauts.sub(lambda m: _umlaut_equivalents[m.group(0)], name)
+    return name.translate(_accent_table)
+
+
+def canonicalize_names(names):
+    canonical = {name: canonicalize_name(name) for name in names.unique()}
+    return names.map(canonical)
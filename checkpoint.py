@@ -0,0 +1,134 @@
+####
+# Per-stage checkpoints for app.py.
+#
+# Multiple runs per data fix are the normal workflow (see README), but most fixes only touch one input.
+# A stage's result only depends on:
+# - the content of its input files,
+# - the config sections it reads,
+# - the code (the app's .py files, see code_version),
+# - the results of the stages it runs after,
+# - any other state the caller passes (e.g. the run date, for results depending on it).
+# Together these make up the stage fingerprint. Results are pickled to `checkpoint_dir` together with
+# their fingerprint, and a rerun with an unchanged fingerprint reuses the pickled result.
+#
+# NOTE: Side effects of a reused stage (printed info, files written to the output folder) do not happen again.
+# Files mentioned in a reused result were written by the run that created the checkpoint.
+####
+import glob
+import hashlib
+import json
+import os
+import os.path
+import pickle
+from functools import cache
+from config import config
+from util import file_hash
+from cached_csv_from_xls import cached_data_dir, is_csv, parse_xls_path
+
+checkpoint_dir = f"{cached_data_dir}/checkpoints"
+hashes_path = f"{checkpoint_dir}/file_hashes.json"
+
+app_dir = os.path.dirname(os.path.abspath(__file__))
+# Packages of the app, next to its top-level modules. Other folders (virtualenvs, data) are not code.
+code_packages = ['hr']
+
+
+def _sha(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+# One hash over the app's python sources, so any code change invalidates all checkpoints.
+@cache
+def code_version():
+    sources = []
+    for folder in [app_dir] + [os.path.join(app_dir, package) for package in code_packages]:
+        sources += sorted(glob.glob(os.path.join(folder, '*.py')))
+
+    return _sha(''.join(file_hash(path) for path in sources))
+
+
+# Our input notation ('folder/[name.xlsx]sheet') to file paths. Folders are expanded to the files they contain.
+def _input_files(path):
+    if os.path.isdir(path):
+        return sorted(os.path.join(root, f)
+                      for root, dirs, files in os.walk(path) for f in files)
+
+    if is_csv(path) or '[' not in path:
+        return [path]
+
+    return [parse_xls_path(path)[0]]
+
+
+class Checkpoints:
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.fingerprints = {}
+        self.known_hashes = {}
+
+        if enabled:
+            os.makedirs(checkpoint_dir, exist_ok=True)
+            if os.path.isfile(hashes_path):
+                with open(hashes_path, 'r') as f:
+                    self.known_hashes = json.load(f)
+
+    # Like cached_csv_from_xls, only hash files whose size or mtime changed since we last hashed them.
+    def _file_fingerprint(self, path):
+        if not os.path.isfile(path):
+            return 'missing'
+
+        stat = os.stat(path)
+        known = self.known_hashes.get(path)
+        if known and known['size'] == stat.st_size and known['mtime'] == stat.st_mtime:
+            return known['hash']
+
+        content_hash = file_hash(path)
+        self.known_hashes[path] = {
+            'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': content_hash}
+        with open(hashes_path, 'w') as f:
+            json.dump(self.known_hashes, f, indent=2, sort_keys=True)
+
+        return content_hash
+
+    def _fingerprint(self, name, inputs, config_sections, after, state):
+        files = {f: self._file_fingerprint(f)
+                 for path in inputs for f in _input_files(path)}
+
+        return _sha(json.dumps({
+            'stage': name,
+            'code': code_version(),
+            'config': {section: config.get(section) for section in config_sections},
+            'files': files,
+            'after': {dep: self.fingerprints[dep] for dep in after},
+            'state': state
+        }, sort_keys=True, default=str))
+
+    ####
+    # Run `compute` (without arguments) as stage `name`, or reuse its checkpoint if nothing changed.
+    # @inputs: input paths in our usual notation, or folders.
+    # @config_sections: top level config.yml sections the stage reads.
+    # @after: names of stages (run before in this run) whose results the stage uses.
+    # @state: other (json serializable) values the result depends on.
+    ####
+    def stage(self, name, compute, inputs=[], config_sections=[], after=[], state={}):
+        if not self.enabled:
+            return compute()
+
+        fingerprint = self._fingerprint(name, inputs, config_sections, after, state)
+        self.fingerprints[name] = fingerprint
+        path = f"{checkpoint_dir}/{name}.pkl"
+
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                checkpoint = pickle.load(f)
+            if checkpoint['fingerprint'] == fingerprint:
+                print(f"Info: stage {name}: inputs unchanged, using checkpoint.")
+                return checkpoint['result']
+
+        result = compute()
+
+        # Write to a temp file first, so an interrupted run can't leave a corrupt checkpoint behind.
+        with open(f"{path}.tmp", 'wb') as f:
+            pickle.dump({'fingerprint': fingerprint, 'result': result}, f)
+        os.replace(f"{path}.tmp", path)
+
+        return result
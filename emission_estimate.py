@@ -0,0 +1,83 @@
+####
+# Provisional emissions for legs atmosfair has not answered yet, so every run produces a complete dataset.
+#
+# Estimates only depend on the great-circle distance between the airports (see airports.py), the distance
+# band and the travel class. They are rough: legs with estimates are flagged in `estimated_col`, and are
+# replaced by atmosfair's numbers as soon as the response is in the store.
+# Legs with an airport we have no coordinates for stay without emissions.
+####
+import numpy as np
+import pandas as pd
+from atmosfair import atmos_def, result_sample_key
+from airports import get_airport_database
+
+estimated_col = 'emissions_estimated'
+
+earth_radius_km = 6371.0
+# Flights are longer than the great circle (routing, holding patterns).
+detour_factor = 1.08
+
+# Distance bands (km, lower bounds) with t CO2 per passenger km in economy, and the RFI2 factor.
+# Short flights burn a larger share of fuel in take-off and spend less time in critical altitudes.
+distance_bands = [0, 500, 1500, 3700]
+co2_per_km = np.array([0.00025, 0.00016, 0.00012, 0.00010])
+rfi2_factors = np.array([1.5, 1.8, 1.9, 1.9])
+# Relative to economy, by canonical (atmosfair) travel class: economy, premium economy, business, first.
+# See bta_fare_class_map in bta_legs_import.py. Unknown classes count as economy.
+class_factors = {'Y': 1.0, 'P': 1.5, 'B': 2.9, 'F': 4.0}
+
+
+def great_circle_km(lon1, lat1, lon2, lat2):
+    lon1, lat1, lon2, lat2 = (np.radians(v) for v in (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + \
+        np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+
+    return 2 * earth_radius_km * np.arcsin(np.sqrt(a))
+
+
+# [lon, lat] arrays for a Series of iata codes, NaN for unknown airports.
+def airport_coordinates(iata):
+    airports = get_airport_database()
+    airports = airports[~airports.index.duplicated()]
+
+    return airports.reindex(iata.astype(str).str.upper())[['lon', 'lat']].to_numpy(dtype=float).T
+
+
+####
+# Estimate emissions of legs (with from, to and class).
+# Returns a frame with the atmos_def columns co2, co2rfi2 and distance, indexed like legs.
+####
+def estimate_emissions(legs):
+    [from_lon, from_lat] = airport_coordinates(legs['from'])
+    [to_lon, to_lat] = airport_coordinates(legs['to'])
+    distance = (great_circle_km(from_lon, from_lat, to_lon, to_lat) * detour_factor).round()
+
+    band = np.searchsorted(distance_bands, np.nan_to_num(distance), side='right') - 1
+    factor = legs['class'].astype(str).str.upper().map(class_factors).fillna(1.0).to_numpy()
+    co2 = distance * co2_per_km[band] * factor
+
+    return pd.DataFrame({
+        atmos_def['co2']: co2,
+        atmos_def['co2rfi2']: co2 * rfi2_factors[band],
+        atmos_def['distance']: distance
+    }, index=legs.index)
+
+
+####
+# Fill in estimates for legs without atmosfair emissions (see merge_emissions), and flag them in estimated_col.
+####
+def estimate_missing_emissions(legs_with_ghg):
+    legs = legs_with_ghg.copy()
+    missing = legs[result_sample_key].isna().to_numpy()
+
+    estimates = estimate_emissions(legs[missing])
+    for col in estimates.columns:
+        legs.loc[missing, col] = estimates[col].to_numpy()
+
+    legs[estimated_col] = missing & legs[atmos_def['co2']].notna().to_numpy()
+
+    if missing.any():
+        print(f"Info: estimated emissions for {legs[estimated_col].sum()} of {missing.sum()} legs "
+              "without atmosfair data.")
+
+    return legs
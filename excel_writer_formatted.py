@@ -1,28 +1,106 @@
 import pandas as pd
+import xlsxwriter
 
+# Column widths are estimated from at most this many rows.
+width_sample_size = 10000
 
-def to_excel(df, filename, **kwargs):
-    writer = pd.ExcelWriter(filename, engine='xlsxwriter')
+# Formats of the legs archive. xlsx is for humans, parquet and csv for reading it back in a program.
+archive_formats = ['xlsx', 'parquet', 'csv']
 
-    sheet_name = kwargs['sheet_name'] if 'sheet_name' in kwargs else 'Sheet1'
 
-    # send df to writer
-    df.to_excel(writer, sheet_name=sheet_name, **kwargs)
+# Width of each column: its longest value (in a sample of rows) or header.
+def _column_widths(df):
+    sample = df
+    if len(df) > width_sample_size:
+        # Always include the first rows, which a human looks at first.
+        sample = pd.concat([df.head(width_sample_size // 2),
+                            df.sample(width_sample_size // 2, random_state=0)])
 
-    # pull worksheet object
-    worksheet = writer.sheets[sheet_name]
-
-    # loop through all columns
-    for idx, col in enumerate(df):
-        series = df[col]
-        max_len = max((
+    return [
+        max((
             # len of largest item
-            series.astype(str).map(len).max(),
+            sample[col].astype(str).str.len().max() if len(sample) else 0,
             # len of column name/header
-            len(str(series.name))
+            len(str(col))
         # adding a little extra space
         )) + 1
+        for col in df]
+
+
+####
+# Write df as a formatted excel sheet (columns wide enough for their content).
+# @constant_memory: Write row by row with xlsxwriter's constant_memory mode, which keeps only the current
+#   row in memory. Use for large frames. The index is not written, all other kwargs of DataFrame.to_excel
+#   are ignored.
+####
+def to_excel(df, filename, constant_memory=False, **kwargs):
+    sheet_name = kwargs['sheet_name'] if 'sheet_name' in kwargs else 'Sheet1'
+    widths = _column_widths(df)
+
+    if constant_memory:
+        _to_excel_rows(df, filename, sheet_name, widths)
+        return
+
+    writer = pd.ExcelWriter(filename, engine='xlsxwriter')
+
+    # send df to writer
+    df.to_excel(writer, **kwargs)
+
+    # pull worksheet object
+    worksheet = writer.sheets[sheet_name]
 
-        # set column width
-        worksheet.set_column(idx, idx, max_len)
+    # Written index columns come first.
+    offset = df.index.nlevels if kwargs.get('index', True) else 0
+    for idx, width in enumerate(widths):
+        worksheet.set_column(idx + offset, idx + offset, width)
     writer.save()
+
+
+# pandas writes cells column by column, but constant_memory requires them row by row.
+# So we write the rows ourselves, with the same header and date formats as pandas.
+def _to_excel_rows(df, filename, sheet_name, widths):
+    workbook = xlsxwriter.Workbook(filename, {
+        'constant_memory': True,
+        'default_date_format': 'yyyy-mm-dd hh:mm:ss'})
+    worksheet = workbook.add_worksheet(sheet_name)
+    header_format = workbook.add_format(
+        {'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+
+    for idx, width in enumerate(widths):
+        worksheet.set_column(idx, idx, width)
+
+    worksheet.write_row(0, 0, [str(col) for col in df.columns], header_format)
+
+    # Python values, with empty cells for NaN/NaT.
+    values = df.astype(object).where(df.notna(), None)
+    for row_idx, row in enumerate(values.itertuples(index=False, name=None)):
+        worksheet.write_row(row_idx + 1, 0, row)
+
+    workbook.close()
+
+
+####
+# Write df to `basename`.<format> for each of the given formats (see archive_formats).
+# Returns the written paths.
+####
+def write_archive(df, basename, formats):
+    paths = []
+    for file_format in formats:
+        path = f"{basename}.{file_format}"
+        if file_format == 'xlsx':
+            to_excel(df, path, constant_memory=True)
+        elif file_format == 'parquet':
+            # Parquet needs one type per column. Mixed object columns (e.g. ids which are sometimes numbers)
+            # are stored as text.
+            df_typed = df.copy()
+            for col in df_typed.columns[df_typed.dtypes == object]:
+                series = df_typed[col]
+                df_typed[col] = series.where(series.isna(), series.astype(str))
+            df_typed.to_parquet(path, index=False)
+        elif file_format == 'csv':
+            df.to_csv(path, index=False)
+        else:
+            raise Exception(f"Unknown archive format '{file_format}', expected one of {archive_formats}.")
+        paths.append(path)
+
+    return paths
@@ -17,38 +17,34 @@ unknown_cols_if_paid = ['pax_name', 'employee_id8', 'employee_id6', 'employment
 
 
 def expand_pax_counts(orig_legs):
-    legs = pd.DataFrame.copy(orig_legs)
     # Prep: integer pax_count
-    legs['pax_count'] = legs['pax_count'].astype('int')
+    pax_count = orig_legs['pax_count'].astype('int').to_numpy()
 
-    # That's wrong for some, we'll reset it for them later.
-    legs['employment subtype'] = legs.apply(
-        lambda row: f"paid by {row['employee_id8']}", axis=1)
+    # Expand rows where pax_count > 1: repeat each row pax_count times.
+    # (A row with pax_count 0 is kept once.)
+    repeats = np.maximum(pax_count, 1)
+    rows = np.repeat(np.arange(len(orig_legs)), repeats)
+    legs = orig_legs.iloc[rows].reset_index(drop=True)
 
-    # Expand rows where pax_count > 1
-    # Helper column to list all pax in a trip of pax_count > 1
-    legs['pax id'] = legs['pax_count'].map(lambda x: list(range(1, x+1)))
-    legs = legs.explode('pax id')
-    legs['trip_id unique'] = legs['trip_id'].astype(
-        str) + "_" + legs['pax id'].astype(str)
+    # Number the pax of each row: 0 is the paying person, 1.. the co-travelers.
+    pax_id = np.arange(len(legs)) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+    is_paid_for = pax_id > 0
 
-    # Remove information that is not known about the paid-for co-travelers
-    legs.loc[legs.index.duplicated(), unknown_cols_if_paid] = np.nan
-    legs.loc[~legs.index.duplicated(), 'employment subtype'] = np.nan
-    # Alternative (one col, and set on both conditions):
-    # legs['Name'] = np.where(~legs.index.duplicated(keep='first'), legs['Name'], np.nan)
-    # legs['employment subtype'] = np.where(legs['Name'].isnull(), legs['employment subtype'], np.nan)
+    legs['employment subtype'] = np.where(
+        is_paid_for, 'paid by ' + legs['employee_id8'].astype(str), np.nan)
 
-    # Encode Trip ID with unique numerical ID
-    legs['trip_id unique'] = pd.Categorical(legs['trip_id unique'])
-    legs['trip_id unique'] = legs['trip_id unique'].cat.codes + 1
+    # Remove information that is not known about the paid-for co-travelers
+    legs.loc[is_paid_for, unknown_cols_if_paid] = np.nan
 
-    # Establish new sort order
-    legs.sort_values(by=['trip_id unique', 'leg_date'], inplace=True)
+    # Every pax of a trip gets a trip of their own: number the (trip_id, pax) pairs, starting at 1.
+    trip_id = legs.groupby([legs['trip_id'], pax_id], sort=True).ngroup() + 1
 
     # Clean up
+    legs.drop(columns=['pax_count', 'trip_id'], inplace=True)
+    legs['trip_id'] = trip_id
+
+    # Establish new sort order
+    legs.sort_values(by=['trip_id', 'leg_date'], inplace=True)
     legs = legs.reset_index(drop=True)
-    legs.drop(columns=['pax_count', 'pax id', 'trip_id'], inplace=True)
-    legs.rename(columns={'trip_id unique': 'trip_id'}, inplace=True)
 
     return legs
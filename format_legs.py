@@ -1,45 +1,75 @@
 import json
+import pandas as pd
 
 
-def clone(data):
-    return json.loads(json.dumps(data))
+def read_json(filename):
+    with open(filename, 'r') as data_file:
+        data = json.load(data_file)
 
+    return data
 
-def remove_if_empty(obj, key):
-    # Remove the property if it is not defined (saving space.)
-    if not obj[key] or obj[key] == '':
-        obj.pop(key)
 
+####
+# Streaming export of the legs for the front-end.
+# Values are serialized straight from the DataFrame: no list of dicts, no copy of them and no json string of the
+# whole file is built in memory. Empty values (see _empty_mask) are dropped while serializing.
+#
+# Layouts:
+# - records: [{"trip_id":1,"from":"ZRH",...}, ...], as readable as the DataFrame itself.
+# - columnar: {"length": n, "columns": {"trip_id": [1, ...], "from": [0, ...], ...},
+#              "dictionaries": {"from": ["AMS", "ZRH", ...], ...}}
+#   Arrays instead of dicts, so keys are not repeated for every leg. Empty values are null.
+#   Columns in dictionary_columns hold indexes into their sorted list of distinct values.
+####
+json_layouts = ['records', 'columnar']
+# Short strings repeated on most legs.
+dictionary_columns = ['from', 'to', 'class', 'flight_reason', 'aircraft_type']
 
-def write_json(filename, data):
-    with open(filename, 'w') as data_file:
-        json.dump(data, data_file)
+_separators = (',', ':')
 
 
-def read_json(filename):
-    with open(filename, 'r') as data_file:
-        data = json.load(data_file)
+# Not defined: NaN/None or an empty string.
+def _empty_mask(series):
+    return series.isna() | (series.astype(object) == '')
 
-    return data
+
+def _dumps(data):
+    return json.dumps(data, separators=_separators)
 
 
-def deep_iterate(obj, fn):
-    def get_keys(obj):
-        if isinstance(obj, list):
-            return list(range(0, len(obj)))
-        elif isinstance(obj, dict):
-            return list(obj.keys())
-        else:
-            raise Exception('unhandled data type')
-    for key in get_keys(obj):
-        if isinstance(obj[key], list) or isinstance(obj[key], dict):
-            deep_iterate(obj[key], fn)
-        else:
-            fn(obj, key)
+def write_records_json(df, filename):
+    columns = list(df.columns)
+    with open(filename, 'w') as data_file:
+        data_file.write('[')
+        for i, row in enumerate(df.itertuples(index=False, name=None)):
+            # Like remove_if_empty: undefined values (and falsy ones, which the front-end treats the same) are left out.
+            record = {column: value for column, value in zip(columns, row)
+                      if value and not pd.isna(value)}
+            data_file.write((',' if i else '') + _dumps(record))
+        data_file.write(']')
+
 
-def compact_dict(obj):
-    data = clone(obj)
+def write_columnar_json(df, filename, dictionary_columns=dictionary_columns):
+    with open(filename, 'w') as data_file:
+        data_file.write('{"length":' + _dumps(len(df)) + ',"columns":{')
+        dictionaries = {}
+        for i, column in enumerate(df.columns):
+            series = df[column]
+            empty = _empty_mask(series).to_numpy()
+            if column in dictionary_columns:
+                codes, uniques = pd.factorize(series.mask(empty), sort=True)
+                dictionaries[column] = uniques.astype(object).tolist()
+                values = pd.Series(codes, dtype=object).where(~empty, None).tolist()
+            else:
+                values = series.astype(object).where(~empty, None).tolist()
+            data_file.write((',' if i else '') + _dumps(column) + ':' + _dumps(values))
+        data_file.write('},"dictionaries":' + _dumps(dictionaries) + '}')
 
-    deep_iterate(data, remove_if_empty)
 
-    return json.dumps(data)
\ No newline at end of file
+def write_legs_json(df, filename, layout='records'):
+    if layout == 'records':
+        write_records_json(df, filename)
+    elif layout == 'columnar':
+        write_columnar_json(df, filename)
+    else:
+        raise Exception(f"Unknown json layout '{layout}', expected one of {json_layouts}.")
@@ -22,6 +22,6 @@
 # new matches and marking them differently from the old ones.
 #####
 from .name_similarity import name_similarity
-from .parse_hr import employees, id8_by_fullname, get_org_fte, hr_issues
+from .parse_hr import get_employees, get_id8_by_fullname, get_org_fte, get_org_fte_table, get_hr_issues, invalidate_hr
 from .find_hr_matches import find_hr_matches, assign_employee_id8, hr_bta_fill_instructions
 from .resolve_demographics import demographics_by_year, merge_demographics
@@ -22,7 +22,7 @@
 # new matches and marking them differently from the old ones.
 #####
 import pandas as pd
-from cached_csv_from_xls import get_or_cache
+from cached_csv_from_xls import read_cached_many
 from excel_writer_formatted import to_excel
 from util import file_timestamp, round_half_up
 import os
@@ -30,7 +30,7 @@ import glob
 from config import config
 
 from .name_similarity import name_similarity
-from .parse_hr import employees, id8_by_fullname
+from .parse_hr import get_employees, get_id8_by_fullname
 
 originals_folder = config['General']['originals_folder']
 output_folder = config['General']['output_folder']
@@ -63,7 +63,7 @@ Filling instructions:
 
 def _bta_id8_map(df):
     result = pd.DataFrame.copy(df)
-    result['employee_id8'] = result[reference_col].map(id8_by_fullname)
+    result['employee_id8'] = result[reference_col].map(get_id8_by_fullname())
     result.rename(columns={bta_pax_col: 'pax_name'}, inplace=True)
     return result[['pax_name', 'employee_id8']]
 
@@ -108,7 +108,7 @@ def _propose_hr_matches(bta_legs_raw):
                                   for col in bta_pax_with_dates.columns.values]
 
     # List of all employees per HR records.
-    hr_list = employees['full name']
+    hr_list = get_employees()['full name']
 
     [proposed_matches, trivial_matches] = name_similarity(
         hr_list, bta_pax_with_dates, 'pax_name')
@@ -139,8 +139,7 @@ def find_hr_matches(bta_legs_raw):
 
     # Some non-trivial similarities are left over.
     # Can we resolve all using the match file(s) previously provided by users?
-    all_matchfiles_xlsx = glob.glob(os.path.join(matches_path, "*.xlsx"))
-    all_matchfiles = [get_or_cache(xlsx) for xlsx in all_matchfiles_xlsx]
+    all_matchfiles = glob.glob(os.path.join(matches_path, "*.xlsx"))
 
     # Trivial case: We have no match files yet to consider.
     if (len(all_matchfiles)) == 0:
@@ -148,8 +147,7 @@ def find_hr_matches(bta_legs_raw):
         return [_bta_id8_map(matched), None, {'output': proposed_hr_filepath, 'input': matches_path}]
 
     # In this case we have some files to match. Check if they cover all cases.
-    manual_matches = pd.concat((pd.read_csv(f, dtype=str)
-                                for f in all_matchfiles))
+    manual_matches = pd.concat(read_cached_many(all_matchfiles))
 
     # Check empty or non-conforming rows in manual input column.
     if manual_matches[manual_matches[ask_match_col].isna()].shape[0] and manual_matches[~manual_matches[ask_match_col].str.casefold().isin(['y', 'nn', 'nr'])].shape[0] > 0:
@@ -3,29 +3,99 @@
 # Approach: Calculate cosine similarities on name bigram based tf-idf.
 # Finding: an (anonymized) name of Fäs Fäsreg matches with Faes Faesreg or Fas Fasreg with a similarity below 20%!
 # So we need at least some pre-processing for Umlauts.
-from string_grouper import match_strings, match_most_similar
+#
+# We used to call string_grouper's match_strings, which keeps up to 100 matches per HR name and then
+# throws away all but the best one per checked name. As the HR roster grows across years, that candidate
+# set got huge. _best_matches computes the same similarities, but only within blocks of names with the same
+# surname initial, and keeps only the top match per name.
+from sklearn.feature_extraction.text import TfidfVectorizer
 import pandas as pd
-import unicodedata
-import re
+import numpy as np
+from canonical_names import canonicalize_names
+
+
+# Number of checked names scored at once. Memory is bounded by chunk_size x (number of references).
+chunk_size = 500
+
+
+# Character bigrams, as string_grouper creates them with ngram_size=2 and no regex.
+def _bigrams(string):
+    string = string.lower()
+    return [string[i:i + 2] for i in range(len(string) - 1)]
+
 
+# Block key of canonical names: the surname initial. Both HR ('last first') and BTA names start with the surname.
+def _block_keys(names):
+    return names.str.strip().str[:1].str.lower()
 
-umlaut_equivalents = [
-    # Keep separators as they letters on each side should not become neightbors in a n-gram
-    (r'[,-./]|\s', ' '),
-    (r'ae', 'ä'),
-    (r'oe', 'ö'),
-    (r'ue', 'ü'),
-]
 
+# Best reference (index into reference_matrix rows) and similarity per row of check_matrix, in chunks.
+def _chunked_argmax(check_matrix, reference_matrix):
+    best_reference = []
+    best_similarity = []
+    for start in range(0, check_matrix.shape[0], chunk_size):
+        scores = check_matrix[start:start + chunk_size] * reference_matrix
+        # On ties the first reference wins, as it did with match_strings.
+        best_reference.append(np.asarray(scores.argmax(axis=1)).ravel())
+        best_similarity.append(scores.max(axis=1).toarray().ravel())
+
+    return [np.concatenate(best_reference or [[]]).astype(int),
+            np.concatenate(best_similarity or [[]])]
+
+
+####
+# For each name in `checks`, find the most similar name in `references`: the cosine similarity of
+# their bigram tf-idf vectors, same as string_grouper (the vectorizer is fit on both lists).
+#
+# Names are blocked by surname initial (see _block_keys): a checked name is only scored against references
+# of its own block, so a misspelled first letter of the surname is never proposed. Within a block, the
+# product of the sparse tf-idf matrices only scores pairs that share at least one bigram. Checked names
+# are scored in chunks, and of each chunk only the best match per name is kept.
+#
+# Returns a frame like match_strings: left_side (reference), right_side (check), similarity.
+# Pairs with a similarity not above min_similarity are dropped.
+####
+def _best_matches(references, checks, min_similarity):
+    vectorizer = TfidfVectorizer(min_df=1, analyzer=_bigrams)
+    vectorizer.fit(pd.concat([references, checks]))
+
+    # Identical names get identical scores: only score each name once.
+    references = references.drop_duplicates().reset_index(drop=True)
+    checks = checks.drop_duplicates().reset_index(drop=True)
+
+    reference_matrix = vectorizer.transform(references).transpose().tocsc()
+    check_matrix = vectorizer.transform(checks)
+
+    reference_blocks = _block_keys(references)
+    check_blocks = _block_keys(checks)
+
+    reference_index = np.zeros(len(checks), dtype=int)
+    similarity = np.zeros(len(checks))
+    for block, block_checks in check_blocks.groupby(check_blocks, sort=False).groups.items():
+        block_references = np.flatnonzero((reference_blocks == block).to_numpy())
+        if len(block_references) == 0:
+            continue
+
+        [best, best_similarity] = _chunked_argmax(
+            check_matrix[block_checks], reference_matrix[:, block_references].tocsr())
+        reference_index[block_checks] = block_references[best]
+        similarity[block_checks] = best_similarity
+
+    matches = pd.DataFrame({
+        'reference_index': reference_index,
+        'check_index': np.arange(len(checks)),
+        'similarity': similarity
+    })
+    matches = matches[matches['similarity'] > min_similarity]
+    # Same order as match_strings had.
+    matches = matches.sort_values(by=['reference_index', 'check_index'])
+
+    return pd.DataFrame({
+        'left_side': references[matches['reference_index']].values,
+        'right_side': checks[matches['check_index']].values,
+        'similarity': matches['similarity'].values
+    })
 
-def canonicalize_umlauts(string):
-    # Need to convert ae => ä first, then normalize ä -> a.
-    for match, new in umlaut_equivalents:
-        string = re.sub(match, new, string)
-    # This not only removes umlauts, but also accents.
-    string = ''.join(c for c in unicodedata.normalize(
-        'NFD', string) if not unicodedata.category(c) == 'Mn')
-    return string
 
 #####
 # name_similarity
@@ -49,19 +119,13 @@ def name_similarity(ref_list, checklist_with_meta, check_key):
     candidates = pd.DataFrame.copy(checklist_with_meta)
     # candidates.rename(columns={check_key: 'check'}, inplace=True)
 
-    reference_names_df['reference canonical'] = reference_names_df.apply(
-        lambda row: canonicalize_umlauts(row['reference']), axis=1)
-
-    candidates['check canonical'] = candidates.apply(
-        lambda row: canonicalize_umlauts(row[check_key]), axis=1)
+    reference_names_df['reference canonical'] = canonicalize_names(
+        reference_names_df['reference'])
 
-    # any_matches can contain multiple proposed match entries for the same "check" name.
-    any_matches = match_strings(reference_names_df['reference canonical'], candidates['check canonical'], ngram_size=2,
-                                regex=r'', max_n_matches=100, min_similarity=0.1)
+    candidates['check canonical'] = canonicalize_names(candidates[check_key])
 
-    # Alternative API:
-    # matches = match_most_similar(reference_names_df, candidates, ngram_size=2,
-    #  regex=r'[,-./]|\s', max_n_matches=3, min_similarity=0.6)
+    any_matches = _best_matches(reference_names_df['reference canonical'],
+                                candidates['check canonical'], min_similarity=0.1)
 
     # Result: left_side is reference_names_df/HR, right_side is candidates/checklist_with_meta
     # Reduce to a single proposed match row for each candidate name to be checked
@@ -27,9 +27,10 @@
 
 import pandas as pd
 import numpy as np
-from cached_csv_from_xls import get_or_cache
+from cached_csv_from_xls import read_cached_many, get_or_cache_many
 from config import config
 from util import round_half_up
+from functools import cache
 from string import ascii_uppercase
 
 originals_folder = config['General']['originals_folder']
@@ -43,10 +44,6 @@ def _round(num):
     return round_half_up(num, 2)
 
 
-# We consume issues in the app for further processing
-hr_issues = []
-
-
 # NOTE: Column names don't match up: (e.g. Jahr vs Jhr)
 #
 # 2017
@@ -83,23 +80,41 @@ available_years = list(hr_data_paths)
 available_years.sort()
 
 
-def to_iso_str(day_first_date):
-    date_comps = day_first_date.split(' ')
-    if not len(date_comps) == 2 or not date_comps[1] == '00:00:00':
-        raise Exception(f'Error: parsing issue at date {day_first_date}')
+# Column types of the excerpts, for both column definitions above. Columns not listed are strings.
+# Categories suit the columns with few distinct values that repeat for every employee and year.
+# FTE stays float64: we sum and round it for the reports, float32 would change the rounded results.
+hr_dtypes = {
+    'yob': 'category',
+    'gender': 'category',
+    'level': 'category',
+    'cost center nr': 'category',
+    'cost center label': 'category',
+    'org code': 'category',
+    'org label': 'category',
+    'top level department': 'category',
+    'employee type': 'category',
+    'FTE contract': 'float64',
+    'FTE salary': 'float64'
+}
+
+
+# Cut '2017-12-31 00:00:00' down to '2017-12-31'.
+def to_iso_str(day_first_dates):
+    invalid = ~day_first_dates.str.match(r'[^ ]* 00:00:00$')
+    if invalid.any():
+        raise Exception(
+            f'Error: parsing issue at date {day_first_dates[invalid.to_numpy()].iloc[0]}')
 
-    return date_comps[0]
+    return day_first_dates.str[:-len(' 00:00:00')]
 
 
 def _read_single_year(year):
-    csv_paths = [get_or_cache(f"{originals_folder}/{filename}")
-                 for filename in hr_data_paths[year]]
+    paths = [f"{originals_folder}/{filename}"
+             for filename in hr_data_paths[year]]
 
     dfs = []
-    for path in csv_paths:
-        # na_filter avoids department named "NULL" becoming NaN
-        df = pd.read_csv(
-            path, dtype=str, na_filter=False)
+    # na_filter avoids department named "NULL" becoming NaN
+    for df in read_cached_many(paths, na_filter=False):
         # set columns inside loop, otherwise we'll aggregate different columns when HR excerpts have slight column
         # naming mismatches.
         df.columns = cols_till_2018 if year < 2019 else cols_starting_2019
@@ -112,123 +127,150 @@ def _read_single_year(year):
     # the excel export more tedious.
     # NOTE 2: The end date (aka 'Austritt') has a 9999 year which
     # fails to parse as a datetime in pandas (out of bounds).
-    df['work start date'] = df.loc[:, 'work start date'].apply(to_iso_str)
-    df['work end date'] = df.loc[:, 'work end date'].apply(to_iso_str)
+    df['work start date'] = to_iso_str(df['work start date'])
+    df['work end date'] = to_iso_str(df['work end date'])
 
     # As we are doing calculations with FTEs, convert to float.
     # Also, normalize to ratio instead of percentage
-    df['FTE contract'] = df.loc[:, 'FTE contract'].astype('float') / 100
-    df['FTE salary'] = df.loc[:, 'FTE salary'].astype('float') / 100
+    df['FTE contract'] = df['FTE contract'].astype(hr_dtypes['FTE contract']) / 100
+    df['FTE salary'] = df['FTE salary'].astype(hr_dtypes['FTE salary']) / 100
 
     return df
 
 
-excerpts_by_year = pd.concat([_read_single_year(year)
-                              for year in available_years])
-excerpts_by_year['full name'] = (
-    excerpts_by_year['last name'] + ' ' + excerpts_by_year['first name'])
+####
+# Collect key issues of the HR excerpts: missing employee ids, and employees listed twice in the same year.
+# Returns a frame with one row per issue: year, employee_id8, comment.
+####
+def _employee_key_issues(excerpts_by_year):
+    id8 = excerpts_by_year['employee_id8']
+    # The excerpts of several years share index labels, so work with plain arrays.
+    missing = (id8.isna() | id8.eq('')).to_numpy()
+    duplicate = ~missing & excerpts_by_year.duplicated(
+        ['employee_id8', 'year']).to_numpy()
 
-# NaN as '' to better calculate.
-excerpts_by_year['org code'].fillna('', inplace=True)
+    issues = excerpts_by_year.loc[missing | duplicate, ['year', 'employee_id8']]
+    issues['comment'] = np.where(
+        missing[missing | duplicate], 'missing employee_id8', 'duplicate employee_id8')
 
-invalid_departments = excerpts_by_year[~excerpts_by_year['org code'].str.casefold(
-).str.get(0).isin(_allowed_departments)]
+    return issues
 
-# Adjust shape for logging
-hr_issues = pd.DataFrame.copy(invalid_departments)
 
-if len(hr_issues):
-    hr_issues.loc[hr_issues['org code'] == '',
-                'comment'] = 'HR excerpt missing org code'
-    hr_issues.loc[hr_issues['org code'] != '', 'comment'] = hr_issues.apply(
-        lambda row: f'HR excerpt invalid org code {row["org code"]}', axis=1)
+def _check_employee_keys(excerpts_by_year):
+    issues = _employee_key_issues(excerpts_by_year)
 
-    hr_issues = hr_issues.loc[:, ['year', 'employee_id8', 'comment', 'full name']]
-    hr_issues.rename(columns={'full name': 'HR name'}, inplace=True)
+    missing = issues['comment'] == 'missing employee_id8'
+    if missing.any():
+        # We don't expect this to happen; all excerpts have it.
+        row = excerpts_by_year[excerpts_by_year['employee_id8'].isna() |
+                               excerpts_by_year['employee_id8'].eq('')].iloc[0]
+        raise Exception(
+            f'Abort: missing 8-digit Personalnummer in HR excerpt of year {row["year"]}:\n{row}.')
 
-# Customer request for 'top level department' which has the first org code letter.
-excerpts_by_year['top level department'] = excerpts_by_year['org code'].str.get(0)
+    if len(issues):
+        for year, duplicates in issues.groupby('year', sort=False):
+            print(
+                f"Duplicate employee numbers {', '.join(duplicates['employee_id8'])} in HR excerpt of year {year}")
+        raise Exception('Aborting because of duplicate employee keys issue')
 
-# Check the HR excertps for some common errors.
-employee_dict = {}
-duplicate_employees = {}
-for _, row in excerpts_by_year.iterrows():
-    year = row['year']
-    pers_id8 = row['employee_id8']
 
-    if pd.isnull(pers_id8) or pers_id8 == '':
-        # We don't expect this to happen; all excerpts have it.
-        raise Exception(
-            f'Abort: missing 8-digit Personalnummer in HR excerpt of year {year}:\n{row}.')
+####
+# Read and check the HR excerpts of all years. This is only done on first use, and then memoized.
+# Use the get_* accessors below, and invalidate_hr to re-read the excerpts.
+####
+@cache
+def _load_hr():
+    # Convert all excerpts of all years in one batch, so stale workbooks are converted in parallel.
+    get_or_cache_many([f"{originals_folder}/{filename}"
+                       for year in available_years for filename in hr_data_paths[year]])
 
-    if pers_id8 not in employee_dict:
-        employee_dict[pers_id8] = {}
+    excerpts_by_year = pd.concat([_read_single_year(year)
+                                  for year in available_years])
+    excerpts_by_year['full name'] = (
+        excerpts_by_year['last name'] + ' ' + excerpts_by_year['first name'])
 
-    if year in employee_dict[pers_id8]:
-        if year not in duplicate_employees:
-            duplicate_employees[year] = []
-        duplicate_employees[year].append(pers_id8)
+    # NaN as '' to better calculate.
+    excerpts_by_year['org code'].fillna('', inplace=True)
 
-    employee_dict[pers_id8][year] = {key: row[key]
-                                     for key in cols_starting_2019}
+    invalid_departments = excerpts_by_year[~excerpts_by_year['org code'].str.casefold(
+    ).str.get(0).isin(_allowed_departments)]
 
-if len(duplicate_employees.keys()):
-    for year in duplicate_employees:
-        print(
-            f"Duplicate employee numbers {', '.join(duplicate_employees[year])} in HR excerpt of year {year}")
-    raise Exception('Aborting because of duplicate employee keys issue')
+    # Adjust shape for logging
+    hr_issues = pd.DataFrame.copy(invalid_departments)
 
+    if len(hr_issues):
+        hr_issues.loc[hr_issues['org code'] == '',
+                    'comment'] = 'HR excerpt missing org code'
+        hr_issues.loc[hr_issues['org code'] != '', 'comment'] = hr_issues.apply(
+            lambda row: f'HR excerpt invalid org code {row["org code"]}', axis=1)
 
-employees = pd.DataFrame.copy(
-    excerpts_by_year[['employee_id8', 'employee_id6', 'full name']])  # , 'year']])
+        hr_issues = hr_issues.loc[:, ['year', 'employee_id8', 'comment', 'full name']]
+        hr_issues.rename(columns={'full name': 'HR name'}, inplace=True)
 
-# NOTE: Here we need to be careful as HR records across different years can list
-# multiple names for the same employee id.
-# This could be due to actual name changes or variation in writing the same name.
-# Specifically, we should not try to create a map where the keys are ids and the
-# values are names.
-employees = employees.groupby(['full name'], sort=True, as_index=False).first()
+    # Customer request for 'top level department' which has the first org code letter.
+    excerpts_by_year['top level department'] = excerpts_by_year['org code'].str.get(0)
 
-# Dict of { employee name: employee id8 }
-id8_by_fullname = dict(zip(employees['full name'], employees['employee_id8']))
+    # Check the HR excertps for some common errors.
+    _check_employee_keys(excerpts_by_year)
 
-employee_id8_years = pd.DataFrame.copy(
-    excerpts_by_year[['employee_id8', 'year']]
-)
-employee_id8_years['years'] = employee_id8_years['year'].apply(str)
-employee_id8_years = employee_id8_years.groupby(
-    ['employee_id8'], sort=True, as_index=False
-).agg({'years': ', '.join})
+    # Categories only after all years are combined, concat would fall back to strings for differing categories.
+    excerpts_by_year = excerpts_by_year.astype(
+        {col: dtype for col, dtype in hr_dtypes.items() if dtype == 'category'})
 
+    # Selecting columns already creates a new frame, no need for a copy.
+    employees = excerpts_by_year[['employee_id8', 'employee_id6', 'full name']]  # , 'year']]
 
-# Department names are nested, i.e. department XYZ is under XY.
-# If we have a sub-department XYZ, but no super-department XY, this is an issue and needs correction.
-# For example: With no org 'LD', but orgs 'LDA' and 'LDB' the cockpit cannot present a correct
-# sunburst ring for 'level 2 departments'.
-def _complete_missing_deps(sum_fte):
-    missing = []
-    for year in available_years:
-        curr_year = sum_fte[year]
+    # NOTE: Here we need to be careful as HR records across different years can list
+    # multiple names for the same employee id.
+    # This could be due to actual name changes or variation in writing the same name.
+    # Specifically, we should not try to create a map where the keys are ids and the
+    # values are names.
+    employees = employees.groupby(['full name'], sort=True, as_index=False).first()
+
+    # Dict of { employee name: employee id8 }
+    id8_by_fullname = dict(zip(employees['full name'], employees['employee_id8']))
+
+    employee_id8_years = excerpts_by_year['year'].astype(str).groupby(
+        excerpts_by_year['employee_id8'].to_numpy(), sort=True).agg(', '.join)
+    employee_id8_years = pd.DataFrame({
+        'employee_id8': employee_id8_years.index, 'years': employee_id8_years.to_numpy()})
 
-        # Find all org codes to check ancestors for.
-        for org_code in list(filter(lambda x: len(x) > 1, curr_year.keys())):
-            # We need to approach this from top department (short) to sub-department (long)
-            # Otherwise, we'll add sub-sub-departments with FTE, then sub-deps with factor 2 FTE.
-            for ancestor in [org_code[:-len(org_code)+i] for i in range(1, len(org_code))]:
-                if ancestor not in curr_year:
-                    if ancestor not in missing:
-                        missing.append(ancestor)
+    return {
+        'excerpts_by_year': excerpts_by_year,
+        'hr_issues': hr_issues,
+        'employees': employees,
+        'id8_by_fullname': id8_by_fullname,
+        'employee_id8_years': employee_id8_years
+    }
 
-                    all_suborgs = list(
-                        filter(lambda code: code.startswith(ancestor), curr_year.keys()))
-                    fte = _round(sum([curr_year[suborg]['fte']
-                                      for suborg in all_suborgs]))
-                    count = int(_round(sum([curr_year[suborg]['count']
-                                        for suborg in all_suborgs])))
-                    curr_year[ancestor] = {'fte': fte, 'count': count}
 
-    if len(missing):
-        print(f'Info: The following org codes had no direct HR entry and were added by this program: ' + ', '.join(missing))
+def invalidate_hr():
+    _load_hr.cache_clear()
+
+
+# All HR excerpts, one row per employee and year.
+def get_excerpts_by_year():
+    return _load_hr()['excerpts_by_year']
+
+
+# We consume issues in the app for further processing
+def get_hr_issues():
+    return _load_hr()['hr_issues']
+
+
+# One row per distinct employee name.
+def get_employees():
+    return _load_hr()['employees']
+
+
+# Dict of { employee name: employee id8 }
+def get_id8_by_fullname():
+    return _load_hr()['id8_by_fullname']
+
+
+# One row per employee id8 with the comma separated list of excerpt years they appear in.
+def get_employee_id8_years():
+    return _load_hr()['employee_id8_years']
 
 
 # This is important as otherwise per FTE count gets to be infinite which is not useful for charts.
@@ -253,37 +295,58 @@ def _verify_no_zero_deps(sum_fte):
             f'The following departments have a 0 FTE count, which is a problem for calculating per FTE counts: {z_list}')
 
 
-def get_org_fte():
-    # Finally, a per-year list of org codes and total FTEs
+####
+# A per-year table of org codes with their total FTE and head count: the FTE of dep 'A' includes 'AA' etc.
+#
+# Department names are nested, i.e. department XYZ is under XY.
+# If we have a sub-department XYZ, but no super-department XY, this is an issue and needs correction.
+# For example: With no org 'LD', but orgs 'LDA' and 'LDB' the cockpit cannot present a correct
+# sunburst ring for 'level 2 departments'. Such missing ancestors are added (column 'added').
+#
+# Every org code is exploded into its prefixes once, and each prefix sums up all org codes starting with it.
+# Columns: year, org code, fte, count, added
+####
+def get_org_fte_table():
     # NOTE: This results in a list where the FTE count of dep 'A' does not include the FTE count of 'AA' etc.
-    org_codes_fte = excerpts_by_year.loc[:, ['year', 'org code', 'FTE contract']].groupby(
-        # ['year', 'org code'], sort=True, as_index=False).sum('FTE contract')
-        ['year', 'org code'], sort=True, as_index=False).agg({'FTE contract': ['sum', 'count']})
-    org_codes_fte.reset_index(inplace=True)
-    org_codes_fte.columns = [' '.join(col).strip()
-                             for col in org_codes_fte.columns.values]
+    org_codes_fte = get_excerpts_by_year().groupby(
+        ['year', 'org code'], sort=True, observed=True)['FTE contract'].agg(['sum', 'count']).reset_index()
+    org_codes_fte['org code'] = org_codes_fte['org code'].astype(str)
+    existing = pd.MultiIndex.from_frame(org_codes_fte[['year', 'org code']])
 
-    # Populate sum_fte with the aggregated FTE counts (A has AA too, etc.).
-    sum_fte = {}
-    for year in available_years:
-        year_org_codes = org_codes_fte[org_codes_fte['year'] == year]
+    # An org code counts towards itself and all its ancestors.
+    org_codes_fte['prefix'] = org_codes_fte['org code'].map(
+        lambda code: [code[:i] for i in range(len(code) + 1)])
+    prefixes = org_codes_fte.explode('prefix')
 
-        sum_fte[year] = {}
+    # Every org code starts with the empty prefix. Like str.startswith('') before, an empty (missing) org code
+    # therefore sums up all org codes of its year. Without an empty org code, the prefix is not added as an ancestor.
+    is_existing = pd.MultiIndex.from_frame(
+        prefixes[['year', 'prefix']]).isin(existing)
+    prefixes = prefixes[(prefixes['prefix'].str.len() > 0).to_numpy() | is_existing]
 
-        for _, row in year_org_codes.iterrows():
-            org = row['org code']
+    org_fte = prefixes.groupby(['year', 'prefix'], sort=True)[
+        ['sum', 'count']].sum().reset_index()
+    org_fte.columns = ['year', 'org code', 'fte', 'count']
 
-            with_subdeps = year_org_codes[year_org_codes['org code'].str.startswith(
-                org)]
-            fte_all = with_subdeps['FTE contract sum'].sum()
-            count_all = with_subdeps['FTE contract count'].sum()
+    org_fte['fte'] = org_fte['fte'].map(_round)
+    org_fte['count'] = org_fte['count'].astype(int)
+    org_fte['added'] = ~pd.MultiIndex.from_frame(
+        org_fte[['year', 'org code']]).isin(existing)
 
-            sum_fte[year][org] = {
-                'fte': _round(fte_all),
-                'count': int(_round(count_all))
-            }
+    return org_fte
 
-    _complete_missing_deps(sum_fte)
+
+def get_org_fte():
+    org_fte = get_org_fte_table()
+
+    added = org_fte.loc[org_fte['added'], 'org code'].unique()
+    if len(added):
+        print(f'Info: The following org codes had no direct HR entry and were added by this program: ' + ', '.join(added))
+
+    # Populate sum_fte with the aggregated FTE counts (A has AA too, etc.).
+    sum_fte = {year: {} for year in available_years}
+    for year, org, fte, count in org_fte[['year', 'org code', 'fte', 'count']].itertuples(index=False):
+        sum_fte[year][org] = {'fte': float(fte), 'count': int(count)}
 
     _verify_no_zero_deps(sum_fte)
 
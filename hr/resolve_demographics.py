@@ -7,18 +7,13 @@
 ####
 
 import pandas as pd
-from .parse_hr import employee_id8_years, excerpts_by_year
+from .parse_hr import get_employee_id8_years, get_excerpts_by_year
 
 # ['pax_name', 'pax_count', 'trip_id', 'from', 'to', 'class', 'leg_date',
 #       'flight_number', 'leg_date_unknown', 'comment', 'provenience', 'cost',
 #       'flight_reason', 'flight_reason_other', 'employee_id8', 'employee_id6']
 
 
-def _years_found(row):
-    return ', '.join(employee_id8_years[employee_id8_years['employee_id8']
-                                        == row['employee_id8']]['years'])
-
-
 def demographics_by_year(all_legs_nohr):
     leg_id8years = all_legs_nohr[[
         'leg_date', 'employee_id8', 'pax_name']].copy()
@@ -35,8 +30,10 @@ def demographics_by_year(all_legs_nohr):
     # This is a no-op. All of them are defined after the groupby
     # leg_id8years = leg_id8years[leg_id8years['employee_id8'].notna()]
 
-    merged_hr = pd.merge(leg_id8years, excerpts_by_year,
-                         how='left', on=['employee_id8', 'year'])
+    # Employee id8 and year are unique in the excerpts, so use them as a sorted index for the lookup.
+    excerpts = get_excerpts_by_year().set_index(
+        ['employee_id8', 'year']).sort_index()
+    merged_hr = leg_id8years.join(excerpts, on=['employee_id8', 'year'])
 
     # merge failures
     missing_hr = merged_hr[merged_hr['work start date'].isna()].copy()
@@ -48,8 +45,10 @@ def demographics_by_year(all_legs_nohr):
         missing_hr.sort_values(by=["year", "employee_id8"], inplace=True)
         missing_hr['comment'] = 'Pax has employee id(8) which is not in the HR excerpt of their flight year'
 
-        missing_hr['found in excerpts'] = missing_hr.apply(
-            lambda row: _years_found(row), axis=1)
+        # Each employee id8 has a single row there.
+        employee_id8_years = get_employee_id8_years().set_index('employee_id8')['years']
+        missing_hr['found in excerpts'] = missing_hr['employee_id8'].map(
+            employee_id8_years).fillna('')
 
         # print('Some travelers have employee ids but are missing in the HR excerpt of their flight year. Adding these to the hr issue list.')
 
@@ -63,21 +62,20 @@ def demographics_by_year(all_legs_nohr):
 
 def merge_demographics(legs, matched_hr):
     merge_legs = pd.DataFrame.copy(legs)
-    # NOTE: legs post GHG have a string leg_date (because of the date matching),
-    # while before it's a datetime (because of optimizing parsing).
-    # This might be considered an issue.
-    merge_legs['leg_date_helper'] = pd.to_datetime(merge_legs['leg_date'])
 
     # We merge HR excerpts year-wise, so this is important
-    merge_legs['year'] = merge_legs['leg_date_helper'].dt.year
+    merge_legs['year'] = merge_legs['leg_date'].dt.year
 
     # Since we don't key on this, we'll get multiple copies if we don't drop it.
-    merge_hr = matched_hr.drop(columns='employee_id6')
+    # matched_hr has a single row per employee id8 and year, so this is a keyed lookup.
+    merge_hr = matched_hr.drop(columns='employee_id6').set_index(
+        ['employee_id8', 'year']).sort_index()
 
-    merged = pd.merge(merge_legs, merge_hr,
-                      how='left', on=['employee_id8', 'year'])
+    # A fresh index, as a merge would give: expand_pax_counts relies on unique index labels.
+    merged = merge_legs.join(
+        merge_hr, on=['employee_id8', 'year']).reset_index(drop=True)
 
     # Now, can drop year because we have leg_date
-    merged.drop(columns=['year', 'leg_date_helper'], inplace=True)
+    merged.drop(columns=['year'], inplace=True)
 
     return merged
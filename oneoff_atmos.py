@@ -35,6 +35,7 @@ import pandas as pd
 import datetime as dt
 from bta_legs_import import bta_legs_import
 from regular_legs_import import regular_legs_import
+from trip_id import next_trip_id
 from config import config
 from excel_writer_formatted import to_excel
 
@@ -46,8 +47,8 @@ output_folder = config['General']['output_folder']
 flight_info = ['from', 'to', 'class', 'leg_date', 'flight_number']
 
 bta = bta_legs_import()
-spesen = regular_legs_import(config['legs']['spesen'])
-airplus = regular_legs_import(config['legs']['airplus'])
+spesen = regular_legs_import(config['legs']['spesen'], next_trip_id(bta))
+airplus = regular_legs_import(config['legs']['airplus'], next_trip_id(spesen))
 
 print('Warning: Per-file provenience is outdated for Airplus and Archive legs')
 bta = bta[['pax_name'] + flight_info]
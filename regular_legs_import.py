@@ -1,8 +1,8 @@
 import pandas as pd
 import numpy as np
-from cached_csv_from_xls import get_or_cache
+from cached_csv_from_xls import read_cached_many
 from config import config
-from trip_id import create_assign_trip
+from trip_id import assign_trip_ids
 
 originals_folder = config['General']['originals_folder']
 
@@ -24,12 +24,12 @@ col_mapping = {'departure': 'from', 'arrival': 'to',
 import_cols = list(col_mapping)
 
 
-def regular_legs_import(leg_files):
-    spesen_csv_paths = [get_or_cache(f"{originals_folder}/{item}")
-                        for item in leg_files]
+# @first_trip_id: trip ids of these legs start here, see trip_id.py
+def regular_legs_import(leg_files, first_trip_id=0):
+    spesen_paths = [f"{originals_folder}/{item}" for item in leg_files]
 
-    all_years = [pd.read_csv(path, dtype=str, parse_dates=date_cols, dayfirst=True, usecols=import_cols)
-                 for path in spesen_csv_paths]
+    all_years = read_cached_many(
+        spesen_paths, parse_dates=date_cols, dayfirst=True, usecols=import_cols)
 
     spesen_nohr = pd.concat(all_years, axis=0)
     spesen_nohr.rename(columns=col_mapping, inplace=True)
@@ -61,12 +61,12 @@ def regular_legs_import(leg_files):
     spesen_nohr['to'] = spesen_nohr['to'].str.upper()
 
     # Group trips by flightAmount aka cost, and employee_id8
-    assign_trip = create_assign_trip(['cost', 'employee_id8'])
-    spesen_nohr['trip_id'] = spesen_nohr.apply(
-        lambda row: assign_trip(row), axis=1)
+    spesen_nohr['trip_id'] = assign_trip_ids(
+        spesen_nohr, ['cost', 'employee_id8'], first_trip_id)
 
     # Label person type as employee or guest depending on whether there is a employee_id8
-    spesen_nohr['employment'] = spesen_nohr.apply(lambda row: 'employee' if pd.notna(row['employee_id8']) or pd.notna(row['employee_id6']) else 'guest', axis=1)
+    spesen_nohr['employment'] = np.where(
+        spesen_nohr['employee_id8'].notna() | spesen_nohr['employee_id6'].notna(), 'employee', 'guest')
 
     return spesen_nohr
 
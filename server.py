@@ -5,7 +5,8 @@ app = Flask(__name__)
 
 @app.route('/')
 def run_app():
-    importlib.import_module('app')
+    # Note: `app` here is the flask app, the pipeline lives in the app module.
+    importlib.import_module('app').run()
     return 'Success!'
 
 @app.route('/status')
@@ -0,0 +1,104 @@
+####
+# Streaming xlsx reader.
+#
+# pd.read_excel loads a whole workbook into memory before we get to filter any rows. Some of
+# our exports (e.g. BTA) go back more than a decade while we only use the last few years.
+# This reader uses openpyxl's read_only mode to walk a sheet row by row and yields batches of
+# rows, so memory is bounded by the batch size.
+#
+# Values are converted to strings the same way pd.read_excel(dtype=str, na_filter=False) does,
+# so the cache content does not depend on which reader created it.
+####
+from openpyxl import load_workbook
+import pandas as pd
+import datetime
+
+
+def _cell_to_str(value):
+    if value is None:
+        return ''
+    # pandas converts integral floats to int (convert_float).
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+# Column names as pandas creates them: unnamed columns get a positional name,
+# duplicates get a .1, .2, .. suffix.
+def _header_names(header):
+    names = []
+    seen = {}
+    for i, value in enumerate(header):
+        name = _cell_to_str(value)
+        if name == '':
+            name = f'Unnamed: {i}'
+
+        if name in seen:
+            seen[name] += 1
+            name = f'{name}.{seen[name]}'
+        else:
+            seen[name] = 0
+        names.append(name)
+
+    return names
+
+
+def _cell_year(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.year
+    if value is None or value == '':
+        return None
+
+    parsed = pd.to_datetime(str(value), dayfirst=True, errors='coerce')
+    return None if pd.isna(parsed) else parsed.year
+
+
+# Remember to close() the workbook: read_only workbooks keep the file open.
+def open_workbook(xls_path):
+    return load_workbook(xls_path, read_only=True, data_only=True)
+
+
+####
+# Yields the column names first, then lists of rows (each a list of strings) of at most batch_size rows.
+#
+# @min_year: optional (column name, year) tuple. Rows where that column holds a date before
+# `year`, or no date at all, are skipped while reading.
+####
+def iter_sheet_batches(workbook, sheet_name, batch_size=10000, min_year=None):
+    rows = workbook[sheet_name].iter_rows(values_only=True)
+
+    header = next(rows, ())
+    columns = _header_names(header)
+    yield columns
+
+    year_col = columns.index(min_year[0]) if min_year else None
+
+    batch = []
+    # Like read_excel, rows without any content are kept as empty strings, unless they are at the end of the sheet.
+    # So they are only written once a row with content follows.
+    blank_rows = 0
+    for row in rows:
+        if all(value is None or value == '' for value in row):
+            blank_rows += 1
+            continue
+
+        if year_col is not None:
+            # Blank rows have no date, so min_year skips them anyway.
+            blank_rows = 0
+            year = _cell_year(row[year_col] if year_col < len(row) else None)
+            if year is None or year < min_year[1]:
+                continue
+
+        batch.extend([[''] * len(columns) for _ in range(blank_rows)])
+        blank_rows = 0
+
+        values = [_cell_to_str(value) for value in row[:len(columns)]]
+        values.extend([''] * (len(columns) - len(values)))
+        batch.append(values)
+
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+    if len(batch):
+        yield batch
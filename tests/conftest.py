@@ -0,0 +1,11 @@
+####
+# The app's modules are top-level modules and config.py reads config.yml from the working directory,
+# so tests run from the repository root.
+####
+import os
+import sys
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+os.chdir(repo_dir)
+sys.path.insert(0, repo_dir)
@@ -0,0 +1,90 @@
+import glob
+import os.path
+from functools import partial
+
+import pandas as pd
+import pytest
+
+import atmosfair
+from atmosfair import q_keys
+from atmosfair_store import open_ledger, record_requests, open_requests, close_requests
+
+
+def _flights(*flight_numbers):
+    return pd.DataFrame([['ZRH', 'LHR', 'Y', '2019-03-24', number] for number in flight_numbers],
+                        columns=q_keys)
+
+
+@pytest.fixture
+def ledger_path(tmp_path):
+    return str(tmp_path / 'atmosfair-requests.sqlite')
+
+
+def test_open_requests_until_answered(ledger_path):
+    con = open_ledger(q_keys, ledger_path)
+    try:
+        record_requests(con, _flights('LX316', 'LX317'), 'to_atmosfair_1.csv', '2019-04-01T10:00:00')
+
+        found = open_requests(con, _flights('LX316', 'LX14'), '2019-01-01T00:00:00')
+        assert found['flight_number'].tolist() == ['LX316']
+        assert found['request'].tolist() == ['to_atmosfair_1.csv']
+
+        # Requests sent before `since` have timed out.
+        assert open_requests(con, _flights('LX316'), '2019-05-01T00:00:00').empty
+
+        close_requests(con, _flights('LX316'), 'response_1.csv')
+        assert open_requests(con, _flights('LX316', 'LX317'), '2019-01-01T00:00:00')[
+            'flight_number'].tolist() == ['LX317']
+    finally:
+        con.close()
+
+
+####
+# _request_missing: a flight is requested once, until its request is answered or times out.
+####
+@pytest.fixture
+def request_missing(tmp_path, ledger_path, monkeypatch):
+    output = tmp_path / 'output'
+    output.mkdir()
+    monkeypatch.setattr(atmosfair, 'output_folder', str(output))
+    monkeypatch.setattr(atmosfair, 'open_ledger', partial(open_ledger, path=ledger_path))
+    monkeypatch.setattr(atmosfair, 'max_request_size', 0)
+    monkeypatch.setattr(atmosfair, 'request_timeout_days', 60)
+
+    def request(missing):
+        [new_files, awaited] = atmosfair._request_missing(missing)
+        all_files = sorted(glob.glob(os.path.join(output, 'to_atmosfair_*.csv')))
+        return [new_files, awaited, all_files]
+
+    return request
+
+
+def test_request_missing_does_not_request_twice(request_missing):
+    [new_files, awaited, all_files] = request_missing(_flights('LX316', 'LX317'))
+    assert len(new_files) == 1 and awaited == []
+    first_request = new_files[0]
+    assert pd.read_csv(first_request, dtype=str)['flightNumber'].tolist() == ['LX316', 'LX317']
+
+    # Same flights again (in the same second even): nothing new is written.
+    [new_files, awaited, all_files] = request_missing(_flights('LX316', 'LX317'))
+    assert new_files == []
+    assert awaited == [first_request]
+    assert all_files == [first_request]
+
+    # Only the flight not requested before goes into a new file, next to the first one.
+    [new_files, awaited, all_files] = request_missing(_flights('LX316', 'LX14'))
+    assert awaited == [first_request]
+    assert len(new_files) == 1 and new_files[0] != first_request
+    assert pd.read_csv(new_files[0], dtype=str)['flightNumber'].tolist() == ['LX14']
+    assert all_files == sorted([first_request, new_files[0]])
+
+
+def test_request_missing_requests_again_after_timeout(request_missing, monkeypatch):
+    [[first_request], _, _] = request_missing(_flights('LX316'))
+
+    monkeypatch.setattr(atmosfair, 'request_timeout_days', -1)
+    [new_files, awaited, all_files] = request_missing(_flights('LX316'))
+
+    assert awaited == []
+    assert len(new_files) == 1
+    assert all_files == sorted([first_request, new_files[0]])
@@ -0,0 +1,106 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import bta_legs_import
+from expand_pax_counts import expand_pax_counts, unknown_cols_if_paid
+from trip_id import assign_trip_ids, next_trip_id
+
+
+def test_assign_trip_ids_starts_a_trip_when_a_key_changes():
+    df = pd.DataFrame({'cost': ['10', '10', '20', '20', '10'],
+                       'employee_id8': ['a', 'a', 'a', 'b', 'b']})
+
+    assert assign_trip_ids(df, ['cost', 'employee_id8']).tolist() == [0, 0, 1, 2, 3]
+    assert assign_trip_ids(df, ['cost', 'employee_id8'], 7).tolist() == [7, 7, 8, 9, 10]
+
+
+def test_assign_trip_ids_undefined_key_always_starts_a_trip():
+    df = pd.DataFrame({'cost': ['10', np.nan, np.nan, '10'],
+                       'employee_id8': ['a', 'a', 'a', 'a']})
+
+    assert assign_trip_ids(df, ['cost', 'employee_id8']).tolist() == [0, 1, 2, 3]
+
+
+def test_next_trip_id():
+    assert next_trip_id(pd.DataFrame({'trip_id': []})) == 0
+    assert next_trip_id(pd.DataFrame({'trip_id': [3, 0, 5, 5]})) == 6
+
+
+####
+# BTA: every booking is one trip, whatever its number of rows.
+####
+leg_zrh_lhr = 'ZRH | LHR | LX | 316 | E | Y | 24.03.2019'
+leg_lhr_zrh = 'LHR | ZRH | LX | 317 | E | Y | 28.03.2019'
+leg_zrh_jfk = 'ZRH | JFK | LX | 14 | E | W | 01.04.2019'
+
+
+def _bta_rows(bookings):
+    rows = []
+    for pax, routing in bookings:
+        # A booking with n legs is listed as n rows repeating the routing. Values are strings as in the
+        # cache, except for the departure date, which is parsed while reading.
+        for _ in routing:
+            row = {'Departure Date': pd.Timestamp('2019-03-24'), 'Airline Km': '1000', 'Pax': pax,
+                   'From Destination': 'ZRH', 'To Destination': 'LHR', 'Department': 'Rektorat',
+                   'Ticket N°2': '1'}
+            for i in range(12):
+                row[f'Routing {i + 1}'] = routing[i] if i < len(routing) else None
+            rows.append(row)
+
+    return pd.DataFrame(rows)
+
+
+@pytest.fixture
+def bta_legs(monkeypatch):
+    def load(bookings, first_trip_id=0):
+        monkeypatch.setattr(bta_legs_import, 'read_cached_many',
+                            lambda *args, **kwargs: [_bta_rows(bookings)])
+        bta_legs_import.invalidate_bta_legs()
+        return bta_legs_import.bta_legs_import(first_trip_id)
+
+    yield load
+    bta_legs_import.invalidate_bta_legs()
+
+
+def test_bta_trip_ids_number_bookings(bta_legs):
+    bookings = [('Muster/Hans', [leg_zrh_lhr, leg_lhr_zrh]),
+                ('Muster/Anna', [leg_zrh_jfk]),
+                ('Muster/Hans', [leg_zrh_jfk, leg_zrh_lhr, leg_lhr_zrh])]
+
+    legs = bta_legs(bookings)
+    assert legs['trip_id'].tolist() == [0, 0, 1, 2, 2, 2]
+    assert legs['from'].tolist() == ['ZRH', 'LHR', 'ZRH', 'ZRH', 'ZRH', 'LHR']
+
+    legs = bta_legs(bookings, first_trip_id=10)
+    assert legs['trip_id'].tolist() == [10, 10, 11, 12, 12, 12]
+    assert next_trip_id(legs) == 13
+
+
+####
+# expand_pax_counts: every pax of a trip gets a trip of their own, numbered from 1 in (trip, pax) order.
+####
+def _legs_with_pax(trip_ids, pax_counts):
+    legs = pd.DataFrame({col: 'x' for col in unknown_cols_if_paid}, index=range(len(trip_ids)))
+    legs['trip_id'] = trip_ids
+    legs['pax_count'] = [str(count) for count in pax_counts]
+    legs['employee_id8'] = [f'e{trip_id}' for trip_id in trip_ids]
+    legs['leg_date'] = pd.date_range('2019-01-01', periods=len(trip_ids))
+    return legs
+
+
+def test_expand_pax_counts_renumbers_trips():
+    # Trip 10 has two legs for two pax, trip 2 one leg for one pax, trip 0 one leg with pax_count 0.
+    legs = expand_pax_counts(_legs_with_pax([10, 10, 2, 0], [2, 2, 1, 0]))
+
+    # Numeric, not lexicographic, order of the trips: 0, 2, 10 (paying pax), 10 (paid-for pax).
+    assert legs['trip_id'].tolist() == [1, 2, 3, 3, 4, 4]
+    assert legs['employee_id8'].tolist()[:4] == ['e0', 'e2', 'e10', 'e10']
+    assert 'pax_count' not in legs.columns
+
+    paid_for = legs[legs['trip_id'] == 4]
+    assert paid_for['employment subtype'].tolist() == ['paid by e10', 'paid by e10']
+    assert paid_for[unknown_cols_if_paid].isna().all().all()
+    assert legs.loc[legs['trip_id'] < 4, 'employment subtype'].isna().all()
+    # Legs of a trip stay in date order.
+    assert paid_for['leg_date'].is_monotonic_increasing
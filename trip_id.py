@@ -1,28 +1,24 @@
-_trip_id = -1
-
 ###
-# checklist: the variables we watch for changes to increment the _trip_id.
-# If checklist is not provided, we create a new id on every call (bta)
+# Trip ids are consecutive integers. Every leg source numbers its trips starting at an explicit first id,
+# so ids stay unique across sources without shared state: pass next_trip_id(legs of the previous source)
+# to the next import.
 ###
-def create_assign_trip(checklist=[]):
-    last_check = {k: None for k in checklist}
-
-    def assign_trip(row = None):
-        global _trip_id
 
-        if not len(checklist):
-            _trip_id += 1
-            return _trip_id
 
-        if row is None:
-            raise Exception('function constructed with checklist, needs row param')
+###
+# Number the trips of df: a new trip starts whenever any of the `keys` columns differs from the previous row.
+# Note that NaN never equals NaN, so a row with an undefined key always starts a new trip.
+###
+def assign_trip_ids(df, keys, first_trip_id=0):
+    values = df[keys]
+    new_trip = (values != values.shift()).any(axis=1)
 
-        if any([row[item] != last_check[item] for item in checklist]):
-            for item in checklist:
-                last_check[item] = row[item]
+    return new_trip.cumsum() - 1 + first_trip_id
 
-            _trip_id += 1
 
-        return _trip_id
+# The first trip id not used by legs.
+def next_trip_id(legs):
+    if not len(legs):
+        return 0
 
-    return assign_trip
+    return int(legs['trip_id'].max()) + 1
@@ -1,4 +1,5 @@
 from datetime import datetime
+import hashlib
 import math
 
 def file_timestamp():
@@ -8,3 +9,13 @@ def file_timestamp():
 def round_half_up(n, decimals=0):
     multiplier = 10 ** decimals
     return math.floor(n*multiplier + 0.5) / multiplier
+
+
+# Content hash of a file, read in chunks so large workbooks don't need to fit into memory.
+def file_hash(path, chunk_size=1024 * 1024):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+
+    return sha.hexdigest()